@@ -3,12 +3,19 @@ import numpy.matlib
 import matplotlib.pyplot as plt
 from math import *
 import scipy
+import scipy.linalg
 from scipy import sparse
+import scipy.sparse.linalg
+import scipy.stats
 from numba import vectorize, float64
 fft=np.fft.fft
 fft2=np.fft.fft2
 ifft=np.fft.ifft
 ifft2=np.fft.ifft2
+rfft=np.fft.rfft
+irfft=np.fft.irfft
+rfft2=np.fft.rfft2
+irfft2=np.fft.irfft2
 
 
 ##############################################################################################
@@ -79,24 +86,24 @@ def sep_exp(x1, x2, ell_1, ell_2):
     '''
     2D speratable exponential covariance function
     Input:
-        x1, x2: coordinates
+        x1, x2: coordinates, scalars or arrays
         ell_1, ell_2: corelated length
     Output:
         c: the covariance
     '''
-    c = exp(- abs(x1) / ell_1 - abs(x2) / ell_2)
+    c = np.exp(- np.abs(x1) / ell_1 - np.abs(x2) / ell_2)
     return c
 
 def gaussA_exp(x1, x2, a11, a22, a12):
     '''
     2D speratable exponential covariance function
     Input:
-        x1, x2: coordinates
+        x1, x2: coordinates, scalars or arrays
         A: 2*2 symmetric matrix
     Output:
         c: covariance
     '''
-    c = exp(- ((x1 ** 2 * a11 + x2 ** 2 * a22) - 2 * x1 * x2 * a12))
+    c = np.exp(- ((x1 ** 2 * a11 + x2 ** 2 * a22) - 2 * x1 * x2 * a12))
     return c
 
 def Whittle_Matern_Cov(t, q=0.5):
@@ -116,8 +123,459 @@ def Whittle_Matern_Cov(t, q=0.5):
     result[non_zero_mask] = factor * (t[non_zero_mask] ** q) * kv(q, t[non_zero_mask])
     return result
 
+##############################################################################################
+# cache of precomputed operators
+from collections import OrderedDict
+from scipy.special import ndtri
+
+class LRU_Cache:
+    '''
+    Least-recently-used cache of expensive precomputations (factorizations, eigenpairs, ...)
+    Input:
+        maxsize: number of entries kept
+    '''
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, build):
+        '''
+        return the entry of key, calling build() to create it on a miss
+        '''
+        if key in self.data:
+            self.data.move_to_end(key)
+            return self.data[key]
+        value = build()
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.data.clear()
+
+##############################################################################################
+# FFT backend
+import os
+from functools import partial
+
+class FFTW_Transform:
+    '''
+    numpy.fft-compatible transform planned once per input shape and dtype with pyfftw.builders,
+    every plan owns aligned input and output buffers
+    Input:
+        kind: name of the transform in numpy.fft, e.g. 'fft', 'irfft2'
+        threads: number of threads of the plans
+        effort: planner effort of FFTW
+        maxsize: number of plans kept
+    '''
+    def __init__(self, kind, threads=1, effort='FFTW_MEASURE', maxsize=16):
+        import pyfftw
+        import pyfftw.builders
+        self.empty = pyfftw.empty_aligned
+        self.builder = getattr(pyfftw.builders, kind)
+        self.threads = threads
+        self.effort = effort
+        self.plans = LRU_Cache(maxsize)
+
+    def __call__(self, a, *args, **kwargs):
+        a = np.asarray(a)
+        if a.dtype.kind != 'c' and a.dtype != np.float64:
+            a = a.astype(np.float64)
+        # planning overwrites the buffer, so plans are made on a fresh aligned array
+        build = lambda: self.builder(self.empty(a.shape, a.dtype), *args, threads=self.threads,
+                                     planner_effort=self.effort, **kwargs)
+        plan = self.plans.get((a.shape, a.dtype.str, repr(args), repr(sorted(kwargs.items()))), build)
+        # the output buffer is reused by the next call of the plan
+        return plan(a).copy()
+
+def Set_FFT_Backend(name='numpy', workers=None, effort='FFTW_MEASURE'):
+    '''
+    Route every spectral routine of this module through one FFT library by rebinding the module-level
+    fft, ifft, fft2, ifft2, rfft, irfft, rfft2, irfft2
+    Input:
+        name: 'numpy'; 'scipy' for scipy.fft with workers threads; 'pyfftw' for planned transforms
+              with workers threads, see FFTW_Transform
+        workers: number of threads, all cores if None
+        effort: planner effort of FFTW for name = 'pyfftw'
+    '''
+    global fft, ifft, fft2, ifft2, rfft, irfft, rfft2, irfft2
+    kinds = ('fft', 'ifft', 'fft2', 'ifft2', 'rfft', 'irfft', 'rfft2', 'irfft2')
+    workers = workers or os.cpu_count()
+    name = name.lower()
+    if name == 'numpy':
+        funcs = [getattr(np.fft, kind) for kind in kinds]
+    elif name == 'scipy':
+        import scipy.fft
+        funcs = [partial(getattr(scipy.fft, kind), workers=workers) for kind in kinds]
+    elif name == 'pyfftw':
+        try:
+            import pyfftw
+        except ImportError:
+            raise ImportError("name='pyfftw' needs pyfftw, use 'scipy' or 'numpy' instead")
+        funcs = [FFTW_Transform(kind, workers, effort) for kind in kinds]
+    else:
+        raise ValueError(f'unknown FFT backend {name}')
+    fft, ifft, fft2, ifft2, rfft, irfft, rfft2, irfft2 = funcs
+
+##############################################################################################
+# streaming output of time-stepping methods
+class P2_Quantile:
+    '''
+    P^2 quantile sketch (Jain & Chlamtac) kept independently on every grid point
+    Input:
+        shape: shape of one observation
+        p: probability of the tracked quantile
+    '''
+    def __init__(self, shape, p):
+        self.p = p
+        self.n = 0
+        self.buf = []
+        self.shape = (shape,) if np.isscalar(shape) else tuple(shape)
+        self.q = np.zeros((5,) + self.shape)
+        self.pos = np.zeros((5,) + self.shape)
+        self.des = np.array([0, 2 * p, 4 * p, 2 + 2 * p, 4])
+        self.inc = np.array([0, p / 2, p, (1 + p) / 2, 1])
+
+    def update(self, x):
+        self.n += 1
+        if self.n <= 5:
+            self.buf.append(np.array(x, dtype=float))
+            if self.n == 5:
+                self.q = np.sort(np.array(self.buf), axis=0)
+                self.pos = np.broadcast_to(np.arange(5.0).reshape((5,) + (1,) * (self.q.ndim - 1)), self.q.shape).copy()
+                self.buf = []
+            return
+        q = self.q; pos = self.pos
+        q[0] = np.minimum(q[0], x); q[4] = np.maximum(q[4], x)
+        k = (x >= q[1]).astype(int) + (x >= q[2]) + (x >= q[3])
+        for i in range(1, 5):
+            pos[i] += (k < i)
+        self.des = self.des + self.inc
+        for i in range(1, 4):
+            d = self.des[i] - pos[i]
+            move = ((d >= 1) & (pos[i + 1] - pos[i] > 1)) | ((d <= -1) & (pos[i - 1] - pos[i] < -1))
+            if not np.any(move):
+                continue
+            s = np.sign(d)
+            qp = q[i] + s / (pos[i + 1] - pos[i - 1]) * ((pos[i] - pos[i - 1] + s) * (q[i + 1] - q[i]) / (pos[i + 1] - pos[i])
+                                                         + (pos[i + 1] - pos[i] - s) * (q[i] - q[i - 1]) / (pos[i] - pos[i - 1]))
+            j = np.where(s > 0, i + 1, i - 1)
+            qj = np.take_along_axis(q, j[None], 0)[0]
+            pj = np.take_along_axis(pos, j[None], 0)[0]
+            ql = q[i] + s * (qj - q[i]) / (pj - pos[i])
+            qnew = np.where((q[i - 1] < qp) & (qp < q[i + 1]), qp, ql)
+            q[i] = np.where(move, qnew, q[i])
+            pos[i] = pos[i] + np.where(move, s, 0)
+
+    @property
+    def value(self):
+        if self.n == 0:
+            return np.full(self.shape, np.nan)
+        if self.n < 5:
+            return np.quantile(np.array(self.buf), self.p, axis=0)
+        return self.q[2].copy()
+
+class Running_Stats:
+    '''
+    Online moments per grid point, merged pairwise (Welford, Chan et al., Pebay) so that no
+    sum of squares is ever formed, with optional histograms and quantile sketches
+    Input:
+        shape: shape of one observation
+        quantiles: probabilities of the quantiles to be tracked
+        moments: 2 for mean and variance, 4 to keep the third and fourth central moments as well
+        bins: edges of a histogram kept on every grid point, values outside are not counted
+    '''
+    def __init__(self, shape, quantiles=(), moments=2, bins=None):
+        shape = (shape,) if np.isscalar(shape) else tuple(shape)
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.M2 = np.zeros(shape)
+        self.moments = moments
+        if moments > 2:
+            self.M3 = np.zeros(shape)
+            self.M4 = np.zeros(shape)
+        self.bins = None if bins is None else np.asarray(bins, dtype=float)
+        if bins is not None:
+            self.counts = np.zeros(np.shape(self.mean) + (self.bins.size - 1,), dtype='int')
+        self.sketches = {p: P2_Quantile(shape, p) for p in quantiles}
+
+    def update(self, x):
+        if self.moments > 2 or self.bins is not None:
+            self.update_batch(np.asarray(x, dtype=float)[None])
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.M2 += delta * (x - self.mean)
+        for sketch in self.sketches.values():
+            sketch.update(x)
+
+    def update_batch(self, X):
+        '''
+        add the observations X[0], X[1], ... at once
+        '''
+        X = np.asarray(X)
+        nb = X.shape[0]
+        if nb == 0:
+            return
+        for sketch in self.sketches.values():
+            for x in X:
+                sketch.update(x)
+        if self.bins is not None:
+            self.counts += self._histogram(X)
+        mean = X.mean(axis=0)
+        D = X - mean
+        if self.moments > 2:
+            self._combine(nb, mean, (D**2).sum(axis=0), (D**3).sum(axis=0), (D**4).sum(axis=0))
+        else:
+            self._combine(nb, mean, (D**2).sum(axis=0))
+
+    def merge(self, other):
+        '''
+        add the observations summarized by another Running_Stats with the same options, the
+        quantile sketches are not merged
+        '''
+        if self.bins is not None:
+            self.counts += other.counts
+        if self.moments > 2:
+            self._combine(other.n, other.mean, other.M2, other.M3, other.M4)
+        else:
+            self._combine(other.n, other.mean, other.M2)
+        return self
+
+    def _combine(self, n, mean, M2, M3=None, M4=None):
+        if n == 0:
+            return
+        na = self.n
+        N = na + n
+        delta = mean - self.mean
+        if self.moments > 2:
+            self.M4 = (self.M4 + M4 + delta**4 * na * n * (na**2 - na * n + n**2) / N**3
+                       + 6 * delta**2 * (na**2 * M2 + n**2 * self.M2) / N**2 + 4 * delta * (na * M3 - n * self.M3) / N)
+            self.M3 = (self.M3 + M3 + delta**3 * na * n * (na - n) / N**2
+                       + 3 * delta * (na * M2 - n * self.M2) / N)
+        self.mean = self.mean + delta * (n / N)
+        self.M2 = self.M2 + M2 + delta**2 * (na * n / N)
+        self.n = N
+
+    def _histogram(self, X):
+        nbins = self.bins.size - 1
+        k = np.searchsorted(self.bins, X, side='right') - 1
+        # the last edge belongs to the last bin, as in np.histogram
+        k[X == self.bins[-1]] = nbins - 1
+        P = self.counts[..., 0].size
+        k = k.reshape(X.shape[0], P)
+        inside = (k >= 0) & (k < nbins)
+        flat = (k + nbins * np.arange(P))[inside]
+        return np.bincount(flat, minlength=P * nbins).reshape(self.counts.shape)
+
+    @property
+    def var(self):
+        return self.M2 / (self.n - 1) if self.n > 1 else np.zeros_like(self.M2)
+
+    @property
+    def skewness(self):
+        '''
+        sample skewness, nan where the variance is 0
+        '''
+        self._check_moments()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.M2 > 0, np.sqrt(self.n) * self.M3 / self.M2**1.5, np.nan)
+
+    @property
+    def kurtosis(self):
+        '''
+        excess kurtosis, nan where the variance is 0
+        '''
+        self._check_moments()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.M2 > 0, self.n * self.M4 / self.M2**2 - 3, np.nan)
+
+    def _check_moments(self):
+        if self.moments < 4:
+            raise ValueError('skewness and kurtosis need Running_Stats(..., moments=4)')
+
+    def ci_halfwidth(self, level=0.95):
+        '''
+        half-width of the normal confidence interval of the mean at the given level, infinite
+        before two observations
+        '''
+        if self.n < 2:
+            return np.full_like(self.M2, np.inf)
+        return ndtri((1 + level) / 2) * np.sqrt(self.var / self.n)
+
+    def quantile(self, p):
+        return self.sketches[p].value
+
+class Trajectory_Recorder:
+    '''
+    Keep the output of a time-stepping method without storing every step
+    Input:
+        t: time grids t_0, ..., t_N
+        shape: shape of one snapshot u_n
+        output: 'full' keeps every step; 'stride' keeps every k-th step and the last one;
+                'final' keeps the last step; 'stats' keeps running statistics over the steps
+        stride: k for output = 'stride'
+        quantiles: quantiles tracked when output = 'stats'
+    '''
+    def __init__(self, t, shape, output='full', stride=1, quantiles=()):
+        self.output = output.lower()
+        self.t = t
+        shape = tuple(shape)
+        N = t.size - 1
+        if self.output == 'full':
+            keep = np.arange(N + 1)
+        elif self.output == 'stride':
+            keep = np.unique(np.hstack([np.arange(0, N + 1, stride), N]))
+        elif self.output == 'final':
+            keep = np.array([N])
+        elif self.output == 'stats':
+            keep = np.array([], dtype='int')
+            self.stats = Running_Stats(shape, quantiles)
+        else:
+            raise ValueError(f'unknown output mode {output}')
+        self.keep = keep
+        self.slot = -np.ones(N + 1, dtype='int')
+        self.slot[keep] = np.arange(keep.size)
+        self.data = np.zeros(shape + (keep.size,))
+
+    def record(self, n, u):
+        if self.output == 'stats':
+            self.stats.update(u)
+        elif self.slot[n] >= 0:
+            self.data[..., self.slot[n]] = u
+
+    def result(self):
+        '''
+        Output:
+            t: time grids of the kept steps
+            data: [..., number of kept steps] snapshots, or the Running_Stats for output = 'stats'
+        '''
+        if self.output == 'stats':
+            return self.t, self.stats
+        return self.t[self.keep], self.data
+
+##############################################################################################
+# quasi-Monte Carlo point sets
+_LATTICE_CACHE = LRU_Cache(8)
+
+def Korobov_Vector(d, m=10, gamma=None):
+    '''
+    Generating vector z = (1, b, b^2, ...) mod 2^m of a Korobov lattice rule, b chosen to minimize the
+    worst-case error in the weighted Korobov space of smoothness 2
+    Input:
+        d: dimension
+        m: the search is done for n = 2^m points
+        gamma: weights of the coordinates, 1/j^2 by default
+    Output:
+        z: [d] generating vector
+    '''
+    def build():
+        n = 2**m
+        g = 1 / np.arange(1, d + 1)**2 if gamma is None else np.asarray(gamma, dtype=float)
+        k = np.arange(n)
+        best, z_best = np.inf, None
+        for b in range(1, n, 2):
+            z = np.ones(d, dtype='int64')
+            for j in range(1, d):
+                z[j] = z[j - 1] * b % n
+            x = np.outer(k, z) % n / n
+            e2 = np.mean(np.prod(1 + g * 2 * pi**2 * (x**2 - x + 1/6), axis=1)) - 1
+            if e2 < best:
+                best, z_best = e2, z
+        return z_best
+    return _LATTICE_CACHE.get((d, m, None if gamma is None else tuple(gamma)), build)
+
+def Radical_Inverse(i):
+    '''
+    van der Corput radical inverse in base 2 of the integers i
+    '''
+    i = np.asarray(i, dtype='uint64')
+    x = np.zeros(i.shape)
+    f = 0.5
+    while np.any(i):
+        x += f * (i & 1)
+        i = i >> np.uint64(1)
+        f /= 2
+    return x
+
+class Point_Sampler:
+    '''
+    Points of [0, 1)^d for Monte Carlo and randomized quasi-Monte Carlo sampling, consecutive calls
+    continue the same sequence
+    Input:
+        d: dimension, the leading coordinates should carry the most important variables
+        kind: 'mc' for i.i.d. points, 'sobol' or 'halton' for scrambled sequences (scipy.stats.qmc),
+              'lattice' for an extensible rank-1 lattice with a random shift
+        rng: Generator or seed of the points, the scrambling or the shift
+        z: generating vector for kind = 'lattice', see Korobov_Vector if None
+    '''
+    def __init__(self, d, kind='sobol', rng=None, z=None):
+        self.d = d
+        self.kind = kind.lower()
+        self.rng = Get_Rng(rng)
+        self.count = 0
+        if self.kind == 'sobol':
+            self.engine = scipy.stats.qmc.Sobol(d, scramble=True, seed=self.rng)
+        elif self.kind == 'halton':
+            self.engine = scipy.stats.qmc.Halton(d, scramble=True, seed=self.rng)
+        elif self.kind == 'lattice':
+            self.z = Korobov_Vector(d) if z is None else np.asarray(z)
+            self.shift = self.rng.random(d)
+        elif self.kind != 'mc':
+            raise ValueError(f'unknown point set {kind}')
+
+    def uniform(self, n):
+        '''
+        Output:
+            U: [n, d] next points, uniform on [0, 1)^d
+        '''
+        if self.kind == 'mc':
+            U = self.rng.random((n, self.d))
+        elif self.kind == 'lattice':
+            # points taken in radical-inverse order, so every 2^m first points form a lattice rule
+            U = (np.outer(Radical_Inverse(np.arange(self.count, self.count + n)), self.z) + self.shift) % 1
+        else:
+            U = self.engine.random(n)
+        self.count += n
+        return U
+
+    def normal(self, n):
+        '''
+        Output:
+            Z: [n, d] next points mapped to standard normals by the inverse distribution function
+        '''
+        return ndtri(np.clip(self.uniform(n), 1e-16, 1 - 1e-16))
+
+def Get_Point_Sampler(sampler, d, rng=None):
+    '''
+    Input:
+        sampler: a Point_Sampler, or a kind of Point_Sampler
+        d: dimension
+        rng: Generator or seed used for a new Point_Sampler
+    Output:
+        a Point_Sampler of dimension d
+    '''
+    if isinstance(sampler, Point_Sampler):
+        if sampler.d < d:
+            raise ValueError(f'the point set has dimension {sampler.d} < {d}')
+        return sampler
+    return Point_Sampler(d, sampler, rng)
+
 ##############################################################################################
 # stochastic process
+def Get_Rng(rng=None):
+    '''
+    Input:
+        rng: None, a seed, a SeedSequence or a numpy.random.Generator
+    Output:
+        a numpy.random.Generator, the global np.random state is never touched
+    '''
+    if isinstance(rng, np.random.Generator):
+        return rng
+    return np.random.default_rng(rng)
+
 def BrownianMotion(T, N, seed=None):
     '''
     Input:
@@ -127,14 +585,10 @@ def BrownianMotion(T, N, seed=None):
     Output:
         t, X
     '''
-    X = np.zeros(N + 1)
     t = np.linspace(0, T, N + 1)
-    X[0] = np.array(0)
     np.random.seed(seed)
     xi = np.random.randn(N)
-    for i in range(1, N+1):
-        dt = t[i] - t[i-1]
-        X[i] = X[i-1] + sqrt(dt)*xi[i-1]
+    X = np.hstack([0, np.cumsum(np.sqrt(np.diff(t)) * xi)])
     return t, X
 
 def BrownianBridge(T, N, seed=None):
@@ -150,10 +604,153 @@ def BrownianBridge(T, N, seed=None):
     B = W - W[-1] * (t - t[0]) / (t[-1] - t[0])
     return t, B
 
+def BrownianMotion_Paths(t, M, rng=None, dtype=np.float64):
+    '''
+    M independent Brownian paths on an arbitrary time grid, W(t[0]) = 0
+    Input:
+        t: increasing time grid t_0 < t_1 < ... < t_N, need not be uniform
+        M: number of paths
+        rng: Generator or seed, see Get_Rng
+        dtype: float64 or float32
+    Output:
+        W: [M, N + 1] paths
+    '''
+    rng = Get_Rng(rng)
+    t = np.asarray(t, dtype=float)
+    N = t.size - 1
+    W = np.empty((M, N + 1), dtype=dtype)
+    W[:, 0] = 0
+    dW = rng.standard_normal((M, N), dtype=dtype)
+    dW *= np.sqrt(np.diff(t)).astype(dtype)
+    np.cumsum(dW, axis=1, out=W[:, 1:])
+    return W
+
+def BrownianBridge_Paths(t, M, rng=None, dtype=np.float64):
+    '''
+    M independent Brownian bridges on an arbitrary time grid, B(t[0]) = B(t[-1]) = 0
+    Input:
+        t: increasing time grid t_0 < t_1 < ... < t_N, need not be uniform
+        M: number of paths
+        rng: Generator or seed, see Get_Rng
+        dtype: float64 or float32
+    Output:
+        B: [M, N + 1] paths
+    '''
+    t = np.asarray(t, dtype=float)
+    W = BrownianMotion_Paths(t, M, rng, dtype)
+    s = ((t - t[0]) / (t[-1] - t[0])).astype(dtype)
+    W -= W[:, -1:] * s
+    return W
+
 ##############################################################################################
 # some processes sampled by discrete KL expansion(spectral decomposition of covariance matrix)
 
-def GP_Exponential_KL(T, N, l, seed=None):
+def Exponential_Cov(h, l):
+    '''
+    exponential covariance exp(-|h|/l), evaluated elementwise on an array of lags h
+    '''
+    return np.exp(-np.abs(h) / l)
+
+def Gaussian_Cov(h, l):
+    '''
+    gaussian covariance exp(-h^2/l^2), evaluated elementwise on an array of lags h
+    '''
+    return np.exp(-(h / l)**2)
+
+def Cov_Matrix(t, cov, *params):
+    '''
+    Covariance matrix of a stationary process on the grid t
+    Input:
+        t: grid points
+        cov: covariance function of the lag, evaluated on a whole array of lags at once
+        params: extra parameters of cov
+    Output:
+        C: [t.size, t.size] covariance matrix
+    '''
+    t = np.asarray(t, dtype=float)
+    dt = np.diff(t)
+    if t.size > 1 and np.allclose(dt, dt[0], rtol=1e-10, atol=0):
+        # uniform grid, C is Toeplitz and only needs the first column
+        return scipy.linalg.toeplitz(cov(np.abs(t - t[0]), *params))
+    return cov(np.abs(t[:, None] - t[None, :]), *params)
+
+def KL_Eigen(C, k=None):
+    '''
+    Eigenpairs of a symmetric covariance matrix
+    Input:
+        C: symmetric covariance matrix
+        k: only compute the k largest eigenpairs, all of them by default
+    Output:
+        S: eigenvalues in descending order, round-off negatives clipped to 0
+        U: eigenvectors
+    '''
+    N = C.shape[0]
+    if k is None or k >= N:
+        S, U = np.linalg.eigh(C)
+    elif k < N // 10:
+        # Lanczos only needs matrix-vector products, much cheaper than a full tridiagonalisation
+        S, U = sparse.linalg.eigsh(C, k=k, which='LA')
+        idx = np.argsort(S)
+        S = S[idx];    U = U[:, idx]
+    else:
+        S, U = scipy.linalg.eigh(C, subset_by_index=[N - k, N - 1])
+    S = np.maximum(S[::-1], 0)
+    U = U[:, ::-1]
+    return S, U
+
+_KL_CACHE = LRU_Cache(4)
+
+def Get_KL_Factor(t, cov, params=(), k=None):
+    '''
+    U*sqrt(S) of the covariance matrix on t, cached on (cov, params, k, t)
+    Input:
+        t: grid points
+        cov: covariance function of the lag
+        params: tuple of extra parameters of cov
+        k: number of KL terms kept, all by default
+    Output:
+        F: [t.size, k] read-only matrix with F F^T = C
+    '''
+    t = np.ascontiguousarray(t, dtype=float)
+    params = tuple(params)
+    def build():
+        S, U = KL_Eigen(Cov_Matrix(t, cov, *params), k)
+        F = U * S**0.5
+        F.setflags(write=False)
+        return F
+    return _KL_CACHE.get((cov, params, k, t.size, t.tobytes()), build)
+
+class KL_Sampler:
+    '''
+    Sampler of a stationary Gaussian process by discrete KL expansion, the eigendecomposition is
+    computed once (and shared through an LRU cache) and every batch of samples is a single product
+    Input:
+        t: grid points
+        cov: covariance function of the lag, e.g. Exponential_Cov, Gaussian_Cov, Whittle_Matern_Cov
+        params: tuple of extra parameters of cov
+        k: number of KL terms kept, all by default
+    '''
+    def __init__(self, t, cov, params=(), k=None):
+        self.t = np.asarray(t, dtype=float)
+        self.F = Get_KL_Factor(self.t, cov, params, k)
+
+    def sample(self, M=1, rng=None, sampler=None):
+        '''
+        Input:
+            M: number of samples
+            rng: Generator or seed, see Get_Rng
+            sampler: Point_Sampler (or its kind) giving the KL coefficients by inverse normal
+                     transform instead of i.i.d. normals, the terms come in decreasing eigenvalues
+        Output:
+            X: [M, t.size] samples
+        '''
+        if sampler is None:
+            xi = Get_Rng(rng).standard_normal((M, self.F.shape[1]))
+        else:
+            xi = Get_Point_Sampler(sampler, self.F.shape[1], rng).normal(M)[:, :self.F.shape[1]]
+        return xi @ self.F.T
+
+def GP_Exponential_KL(T, N, l, seed=None, k=None):
     '''
     Gaussian process with exponential covariance
     Input:
@@ -161,22 +758,18 @@ def GP_Exponential_KL(T, N, l, seed=None):
         N: partition into N intervals
         l: param of exponential covariance function
         seed: random seed
+        k: number of KL terms kept, all N + 1 by default
     Output:
         t, X
     '''
     t = np.linspace(0, T, N + 1)
-    C = np.zeros((N + 1, N + 1))
-    for i in range(N + 1):
-        for j in range(N + 1):
-            ti = t[i]; tj = t[j]
-            C[i, j] = exp(-abs(ti-tj)/l)
-    S, U = np.linalg.eig(C)
+    F = Get_KL_Factor(t, Exponential_Cov, (l,), k)
     np.random.seed(seed)
-    xi = np.random.randn(N + 1)
-    X = np.dot(U, S**0.5 * xi)
+    xi = np.random.randn(F.shape[1])
+    X = np.dot(F, xi)
     return t, X
 
-def GP_Gaussian_KL(T, N, l, seed=None):
+def GP_Gaussian_KL(T, N, l, seed=None, k=None):
     '''
     Gaussian process with gaussian covariance
     Input:
@@ -184,33 +777,22 @@ def GP_Gaussian_KL(T, N, l, seed=None):
         N: partition into N intervals
         l: param of gaussian covariance function
         seed: random seed
+        k: number of KL terms kept, all N + 1 by default
     Output:
         t, X
     '''
     t = np.linspace(0, T, N + 1)
-    C = np.zeros((N + 1, N + 1))
-    for i in range(N + 1):
-        for j in range(N + 1):
-            ti = t[i]; tj = t[j]
-            C[i, j] = exp(-(ti-tj)**2/l**2)
-    S, U = np.linalg.eig(C)
+    F = Get_KL_Factor(t, Gaussian_Cov, (l,), k)
     np.random.seed(seed)
-    xi = np.random.randn(N + 1)
-    X = np.dot(U, S**0.5 * xi)
+    xi = np.random.randn(F.shape[1])
+    X = np.dot(F, xi)
     return t, X
 
-def Gaussian_Whittle_Matern_KL(t, q, seed=None):
-    N = t.size
-    C = np.zeros((N, N))
-    for i in range(N):
-        for j in range(N):
-            ti = t[i]; tj = t[j]
-            h = abs(ti - tj)
-            C[i, j] = Whittle_Matern_Cov(h, q)
-    S, U = np.linalg.eig(C)
+def Gaussian_Whittle_Matern_KL(t, q, seed=None, k=None):
+    F = Get_KL_Factor(t, Whittle_Matern_Cov, (q,), k)
     np.random.seed(seed)
-    xi = np.random.randn(N) 
-    X = np.dot(U, S**0.5 * xi)
+    xi = np.random.randn(F.shape[1])
+    X = np.dot(F, xi)
     return X  
 
 
@@ -225,9 +807,9 @@ def Circulant_Sample(c):
         X, Y: two uncorrelated processes
     '''
     N = c.size
-    d = np.fft.ifft(c) * N
+    d = ifft(c) * N
     xi = np.dot(np.random.randn(N, 2), [1, 1j])
-    Z = np.fft.fft(d**0.5 * xi) / sqrt(N)
+    Z = fft(d**0.5 * xi) / sqrt(N)
     X = np.real(Z)
     Y = np.imag(Z)
     return X, Y
@@ -257,13 +839,13 @@ def Circulant_Embed_Approx(c):
     '''
     c_tilde = np.hstack([c, c[-2:0:-1]])
     N_tilde = c_tilde.size
-    d = np.real(np.fft.ifft(c_tilde)) * N_tilde
+    d = np.real(ifft(c_tilde)) * N_tilde
     d_minus = np.maximum(-d, 0)
     d_pos = np.maximum(d, 0)
     if (np.max(d_minus) > 0):
         print(f'rho(D_minus) = {np.max(d_minus):.4e}')
     xi=np.dot(np.random.randn(N_tilde, 2), [1, 1j])
-    Z = np.fft.fft(d_pos**0.5 * xi) / sqrt(N_tilde)
+    Z = fft(d_pos**0.5 * xi) / sqrt(N_tilde)
     N = c.size
     X=np.real(Z[0:N]);    Y=np.imag(Z[0:N])
     return X, Y
@@ -283,10 +865,95 @@ def rho_D_minus(c):
     '''
     c_tilde = np.hstack([c, c[-2:0:-1]])
     N_tilde = c_tilde.size
-    d = np.real(np.fft.ifft(c_tilde)) * N_tilde
+    d = np.real(ifft(c_tilde)) * N_tilde
     d_minus = np.maximum(-d, 0)
     return np.max(d_minus)
 
+def Smooth_Sizes(lo, hi):
+    '''
+    sorted FFT-friendly sizes 2^i 3^j 5^k in [lo, hi]
+    '''
+    sizes = []
+    p5 = 1
+    while p5 <= hi:
+        p35 = p5
+        while p35 <= hi:
+            p = p35
+            while p <= hi:
+                if p >= lo:
+                    sizes.append(p)
+                p *= 2
+            p35 *= 3
+        p5 *= 5
+    return sorted(sizes)
+
+def Next_Smooth(n):
+    '''
+    smallest size 2^i 3^j 5^k >= n
+    '''
+    n = max(int(n), 1)
+    return Smooth_Sizes(n, 2 * n)[0]
+
+def Min_Smooth_Size(ok, n0, max_size):
+    '''
+    Smallest FFT-friendly size L >= n0 with ok(L), by doubling then bisection (assuming ok is
+    monotone in L)
+    Input:
+        ok: test of a size
+        n0: smallest size allowed
+        max_size: largest size tried
+    Output:
+        L, or None if ok fails up to max_size
+    '''
+    lo = Next_Smooth(n0)
+    if ok(lo):
+        return lo
+    while True:
+        hi = Next_Smooth(2 * lo)
+        if hi > max_size:
+            sizes = Smooth_Sizes(lo + 1, max_size)
+            if len(sizes) == 0 or not ok(sizes[-1]):
+                return None
+            hi = sizes[-1]
+        if ok(hi):
+            break
+        lo = hi
+    cand = Smooth_Sizes(lo + 1, hi - 1)
+    i, j = 0, len(cand)
+    while i < j:
+        mid = (i + j) // 2
+        if ok(cand[mid]):
+            j = mid
+        else:
+            i = mid + 1
+    return cand[i] if i < len(cand) else hi
+
+_PAD_CACHE = LRU_Cache(32)
+
+def Min_Padding_1D(cov, N, dt, params=(), tol=1e-10, max_pad=None):
+    '''
+    Smallest padding M such that the circulant embedding of N + M uniformly spaced points is non-negative
+    definite within tol, with FFT length 2(N + M - 1) a product of 2, 3 and 5. Cached on (cov, params, N, dt, tol)
+    Input:
+        cov: covariance function of the lag, evaluated on an array of lags
+        N: number of sample points
+        dt: grid spacing
+        params: tuple of extra parameters of cov
+        tol: tolerance on rho(D_minus)
+        max_pad: largest padding tried, 64 * N by default
+    Output:
+        M: padding size
+    '''
+    params = tuple(params)
+    max_pad = 64 * N if max_pad is None else max_pad
+    def build():
+        ok = lambda L: rho_D_minus(cov(np.arange(L + 1) * dt, *params)) <= tol
+        L = Min_Smooth_Size(ok, max(N - 1, 1), N - 1 + max_pad)
+        if L is None:
+            raise ValueError(f'no padding up to {max_pad} reaches rho(D_minus) <= {tol}')
+        return L - N + 1
+    return _PAD_CACHE.get(('1d', cov, params, N, dt, tol), build)
+
 def rho_WM(N, dt, q):
     M = np.linspace(100, 10000, 100)
     rho = np.zeros(M.size)
@@ -299,7 +966,9 @@ def rho_WM(N, dt, q):
         rho[i] = c
     return  N+M, rho
 
-def Circulant_Approx_WM(N, M, dt, q):
+def Circulant_Approx_WM(N, M, dt, q, tol=1e-10):
+    if M is None:
+        M = Min_Padding_1D(Whittle_Matern_Cov, N, dt, (q,), tol)
     Ndash = N + M - 1
     T = (Ndash + 1) * dt
     t = np.linspace(0, T, Ndash+1)
@@ -308,25 +977,98 @@ def Circulant_Approx_WM(N, M, dt, q):
     X = X[0:N];    Y = Y[0:N];    t = t[0:N]
     return t, X, Y, c
 
+class Circulant_Sampler:
+    '''
+    Reusable circulant embedding sampler, sqrt of the eigenvalues is computed once and every
+    batch of sample pairs costs a single batched FFT
+    Input:
+        c: first column of the covariance matrix, Toeplitz if embed is True, circulant otherwise
+        embed: embed the symmetric Toeplitz matrix into a circulant matrix
+    '''
+    def __init__(self, c, embed=True):
+        c = np.asarray(c, dtype=float)
+        self.N = c.size
+        c_tilde = np.hstack([c, c[-2:0:-1]]) if embed else c
+        self.N_tilde = c_tilde.size
+        d = np.real(ifft(c_tilde)) * self.N_tilde
+        self.rho = max(-np.min(d), 0)  # rho(D_minus), 0 if the embedding is non-negative definite
+        self.sqrt_d = np.sqrt(np.maximum(d, 0) / self.N_tilde)
+
+    @classmethod
+    def from_cov(cls, cov, N, dt, params=(), tol=None, max_pad=None):
+        '''
+        Build the sampler of N uniformly spaced points from a covariance function, padding
+        the grid with the smallest FFT-friendly size such that rho(D_minus) <= tol
+        Input:
+            cov: covariance function of the lag, evaluated on an array of lags
+            N: number of sample points
+            dt: grid spacing
+            params: tuple of extra parameters of cov
+            tol: tolerance on rho(D_minus), None means no padding
+            max_pad: largest padding tried, 64 * N by default
+        Output:
+            sampler
+        '''
+        m = 0 if tol is None else Min_Padding_1D(cov, N, dt, params, tol, max_pad)
+        sampler = cls(cov(np.arange(N + m) * dt, *params))
+        sampler.N = N
+        sampler.pad = m
+        return sampler
+
+    def sample(self, M=1, rng=None):
+        '''
+        Input:
+            M: number of sample pairs
+            rng: Generator or seed, see Get_Rng
+        Output:
+            X, Y: [M, N] two uncorrelated batches of samples
+        '''
+        rng = Get_Rng(rng)
+        xi = rng.standard_normal((M, self.N_tilde)) + 1j * rng.standard_normal((M, self.N_tilde))
+        return self.transform(xi)
+
+    def transform(self, xi):
+        '''
+        Input:
+            xi: [M, N_tilde] complex standard normal vectors, e.g. from another random stream
+        Output:
+            X, Y: [M, N] two uncorrelated batches of samples
+        '''
+        Z = fft(self.sqrt_d * xi, axis=-1)[:, :self.N]
+        return np.real(Z), np.imag(Z)
+
 ##############################################################################################
 # Circulant Embedding method for Gaussian stationary Random Fields
 
-def Reduced_Cov(n1, n2, dx1, dx2, c):
+_COV_CACHE = LRU_Cache(8)
+
+def Reduced_Cov(n1, n2, dx1, dx2, c, params=()):
     '''
     given a covariance function c, get the reduced vector of covariance matrix.
     Input:
         n1, n2: resolution of x, y axis respectively
         dx1:
         dx2:
-        c: the covariance function, take two params as input
+        c: the covariance function, take two params as input, evaluated on the whole lag grid
+           at once if it accepts arrays
+        params: tuple of extra parameters of c, the result is cached on (c, params, n1, n2, dx1, dx2)
     Output:
-        C_red: reduced vector of covariance matrix
+        C_red: reduced vector of covariance matrix (read-only)
     '''
-    C_red = np.zeros((2*n1 - 1, 2*n2 - 1))
-    for i in range(2*n1 - 1):
-        for j in range(2*n2 - 1):
-            C_red[i, j] = c((i+1-n1)*dx1, (j+1-n2)*dx2)
-    return C_red
+    params = tuple(params)
+    def build():
+        x1 = (np.arange(2 * n1 - 1) + 1 - n1) * dx1
+        x2 = (np.arange(2 * n2 - 1) + 1 - n2) * dx2
+        X1, X2 = np.meshgrid(x1, x2, indexing='ij')
+        try:
+            C_red = np.asarray(c(X1, X2, *params), dtype=float)
+        except TypeError:
+            # c only takes scalars, e.g. written with math.exp
+            C_red = np.vectorize(c, otypes=[float])(X1, X2, *params)
+        C_red = np.array(np.broadcast_to(C_red, X1.shape))
+        C_red.setflags(write=False)
+        return C_red
+    return _COV_CACHE.get((c, params, n1, n2, dx1, dx2), build)
 
 def Circulant_Sample_2d(C_red, n1, n2, seed = 24):
     '''
@@ -339,7 +1081,7 @@ def Circulant_Sample_2d(C_red, n1, n2, seed = 24):
         X, Y: two unrealted realizations
     '''
     N = n1 * n2
-    Lam = N * np.fft.ifft2(C_red)
+    Lam = N * ifft2(C_red)
     d = np.ravel(np.real(Lam))
     d_minus = np.maximum(- d, 0)
     if np.max(d_minus > 0):
@@ -347,7 +1089,7 @@ def Circulant_Sample_2d(C_red, n1, n2, seed = 24):
     np.random.seed(seed)
     xi = np.random.randn(n1, n2) + 1j*np.random.randn(n1, n2)
     V = (Lam ** 0.5)*xi
-    Z = np.fft.fft2(V) / sqrt(N)
+    Z = fft2(V) / sqrt(N)
     X = np.real(Z);    Y = np.imag(Z)
     return X, Y
 
@@ -366,9 +1108,7 @@ def Circulant_Embed_Sample_2d(C_red, n1, n2, seed = None):
     tilde_C_red[1:2*n1, 1:2*n2] = C_red
     tilde_C_red = np.fft.fftshift(tilde_C_red)
     u1, u2 = Circulant_Sample_2d(tilde_C_red, 2*n1, 2*n2, seed)
-    u1 = np.ravel(u1);  u2=np.ravel(u2)
-    u1 = u1[0:2*N]; u1 = u1.reshape((n1, 2 * n2)); u1 = u1[:,::2]
-    u2 = u2[0:2*N]; u2 = u2.reshape((n1, 2 * n2)); u2 = u2[:,::2]
+    u1 = u1[0:n1, 0:n2];    u2 = u2[0:n1, 0:n2]
     return u1, u2
 
 def Circulant_Embed_Approx_2d(C_red, n1, n2, m1, m2, seed = None):
@@ -388,12 +1128,101 @@ def Circulant_Embed_Approx_2d(C_red, n1, n2, m1, m2, seed = None):
     tilde_C_red[1:2 * nn1, 1:2 * nn2] = C_red
     tilde_C_red = np.fft.fftshift(tilde_C_red)
     u1, u2 = Circulant_Sample_2d(tilde_C_red, 2 * nn1, 2 * nn2, seed)
-    # print(u1.shape, u2.shape)
-    u1 = np.ravel(u1);    u2 = np.ravel(u2)
-    u1 = u1[0:2 * N];    u1 = u1.reshape((nn1, 2 * nn2));    u1 = u1[0:n1, 0:2*n2:2]
-    u2 = u2[0:2 * N];    u2 = u2.reshape((nn1, 2 * nn2));    u2 = u2[0:n1, 0:2*n2:2]
+    u1 = u1[0:n1, 0:n2];    u2 = u2[0:n1, 0:n2]
     return u1, u2
 
+def rho_D_minus_2d(C_red, n1, n2):
+    '''
+    compute maximun eigenvalue of D_ of the BCCB embedding of the n1 x n2 grid with reduced vector C_red
+    '''
+    tilde_C_red = np.zeros((2 * n1, 2 * n2))
+    tilde_C_red[1:2 * n1, 1:2 * n2] = C_red
+    Lam = np.real(ifft2(np.fft.fftshift(tilde_C_red))) * (4 * n1 * n2)
+    return max(-np.min(Lam), 0)
+
+def Min_Padding_2D(cov, n1, n2, dx1, dx2, params=(), tol=1e-10, max_pad=None):
+    '''
+    Smallest padding (m1, m2) such that the circulant embedding of the (n1 + m1) x (n2 + m2) grid is
+    non-negative definite within tol. Both directions are padded by the same amount up to FFT-friendly sizes
+    (products of 2, 3 and 5). Cached on (cov, params, n1, n2, dx1, dx2, tol)
+    Input:
+        cov: covariance function c(x1, x2, *params), evaluated on arrays
+        n1, n2: resolution of x, y axis
+        dx1, dx2: grid spacing
+        params: tuple of extra parameters of cov
+        tol: tolerance on rho(D_minus)
+        max_pad: largest padding tried, 16 * max(n1, n2) by default
+    Output:
+        m1, m2: padding sizes
+    '''
+    params = tuple(params)
+    max_pad = 16 * max(n1, n2) if max_pad is None else max_pad
+    def sizes(L):
+        return L, Next_Smooth(n2 + L - n1)
+    def ok(L):
+        nn1, nn2 = sizes(L)
+        return rho_D_minus_2d(Reduced_Cov(nn1, nn2, dx1, dx2, cov, params), nn1, nn2) <= tol
+    def build():
+        L = Min_Smooth_Size(ok, n1, n1 + max_pad)
+        if L is None:
+            raise ValueError(f'no padding up to {max_pad} reaches rho(D_minus) <= {tol}')
+        nn1, nn2 = sizes(L)
+        return nn1 - n1, nn2 - n2
+    return _PAD_CACHE.get(('2d', cov, params, n1, n2, dx1, dx2, tol), build)
+
+class Circulant_Sampler2D:
+    '''
+    Reusable circulant embedding sampler of 2D random fields, the BCCB eigenvalues are computed
+    once and every batch of field pairs costs a single batched fft2
+    Input:
+        C_red: reduced vector of the covariance matrix on the padded (n1 + m1) x (n2 + m2) grid
+        n1, n2: resolution of x, y axis
+        m1, m2: padding size of x, y axis, 0 for the plain embedding
+    '''
+    def __init__(self, C_red, n1, n2, m1=0, m2=0):
+        self.n1 = n1;    self.n2 = n2
+        nn1 = n1 + m1;    nn2 = n2 + m2
+        tilde_C_red = np.zeros((2 * nn1, 2 * nn2))
+        tilde_C_red[1:2 * nn1, 1:2 * nn2] = C_red
+        tilde_C_red = np.fft.fftshift(tilde_C_red)
+        N = 4 * nn1 * nn2
+        Lam = np.real(N * ifft2(tilde_C_red))
+        self.rho = max(-np.min(Lam), 0)  # rho(D_minus), 0 if the embedding is non-negative definite
+        self.sqrt_lam = np.sqrt(np.maximum(Lam, 0) / N)
+
+    @classmethod
+    def from_cov(cls, cov, n1, n2, dx1, dx2, params=(), tol=1e-10, max_pad=None):
+        '''
+        Build the sampler of an n1 x n2 grid from a covariance function, with the padding of Min_Padding_2D
+        Input:
+            cov: covariance function c(x1, x2, *params), evaluated on arrays
+            n1, n2: resolution of x, y axis
+            dx1, dx2: grid spacing
+            params: tuple of extra parameters of cov
+            tol: tolerance on rho(D_minus)
+            max_pad: largest padding tried
+        Output:
+            sampler
+        '''
+        m1, m2 = Min_Padding_2D(cov, n1, n2, dx1, dx2, params, tol, max_pad)
+        sampler = cls(Reduced_Cov(n1 + m1, n2 + m2, dx1, dx2, cov, params), n1, n2, m1, m2)
+        sampler.pad = (m1, m2)
+        return sampler
+
+    def sample(self, M=1, rng=None):
+        '''
+        Input:
+            M: number of field pairs
+            rng: Generator or seed, see Get_Rng
+        Output:
+            X, Y: [M, n1, n2] two uncorrelated stacks of realizations
+        '''
+        rng = Get_Rng(rng)
+        shape = (M,) + self.sqrt_lam.shape
+        xi = rng.standard_normal(shape) + 1j * rng.standard_normal(shape)
+        Z = fft2(self.sqrt_lam * xi)[:, 0:self.n1, 0:self.n2]
+        return np.real(Z), np.imag(Z)
+
 ##############################################################################################
 # KL expansion for Random Fields
 
@@ -406,23 +1235,42 @@ def f_odd(w, l, a):
 def f_even(w, l, a):
     return l**(-1) * np.sin(w * a) + w * np.cos(w * a)
 
+def Root_W(n, l, a, tol=1e-14, maxiter=100):
+    '''
+    All n frequencies of the exponential covariance on [-a, a] at once, by safeguarded Newton
+    iteration inside the brackets [(i-1)pi/(2a), i pi/(2a)], odd i solving f_odd and even i f_even
+    Input:
+        n: number of frequencies
+        l: param of exponential covariance
+        a: space domain [-a, a]
+    Output:
+        w: frequencies
+    '''
+    i = np.arange(1, n + 1)
+    odd = i % 2 == 1
+    lo = (i - 1) * pi / (2 * a);    hi = i * pi / (2 * a)
+    def F(w):
+        s = np.sin(w * a);    c = np.cos(w * a)
+        f = np.where(odd, c / l - w * s, s / l + w * c)
+        df = np.where(odd, -a * s / l - s - a * w * c, a * c / l + c - a * w * s)
+        return f, df
+    sign_lo = np.sign(F(lo)[0])
+    w = (lo + hi) / 2
+    for it in range(maxiter):
+        f, df = F(w)
+        left = np.sign(f) == sign_lo
+        lo = np.where(left, w, lo);    hi = np.where(left, hi, w)
+        w_new = w - f / df
+        out = ~((w_new > lo) & (w_new < hi))
+        w_new[out] = (lo[out] + hi[out]) / 2
+        done = np.all(np.abs(w_new - w) <= tol * (1 + np.abs(w)))
+        w = w_new
+        if done:
+            break
+    return w
+
 def root_w(n, l, a):
-    roots = []
-    for i in range(1,n+1):
-        if i%2 == 0:
-            f = lambda x: f_even(x, l, a)
-        else:
-            f = lambda x: f_odd(x, l, a)
-        left = (i - 1) * np.pi/2
-        right = i * np.pi/2
-        try:
-            result = root_scalar(f, bracket=[left, right], method='brentq')
-            if result.converged:
-                roots.append(result.root)
-        except ValueError:
-            print(f'{left}and{right}error')
-            pass
-    return np.array(roots)
+    return Root_W(n, l, a)
 
 def eigen_v(w, l):
     return 2*l**(-1) / (w**2 + l**(-2))
@@ -430,13 +1278,24 @@ def eigen_v(w, l):
 def phi(x, i, w, a):
     w = w[i]
     if i%2 == 0:
-        coe = 1/sqrt(a + np.sin(w**a)/(2*w))
+        coe = 1/sqrt(a + np.sin(2*w*a)/(2*w))
         return coe * np.cos(w * x)
     else:
-        coe = 1/sqrt(a - np.sin(w**a)/(2*w))
+        coe = 1/sqrt(a - np.sin(2*w*a)/(2*w))
         return coe * np.sin(w * x)
-    
-def Exponential_Gaussian_RF_KL(grid, J, l, a):
+
+def Phi_Matrix(x, w, a):
+    '''
+    All eigenfunctions phi(x, i, w, a), i = 0, ..., w.size - 1 at once
+    Output:
+        Phi: [x.size, w.size] matrix
+    '''
+    even = np.arange(w.size) % 2 == 0
+    coe = 1 / np.sqrt(a + np.where(even, 1, -1) * np.sin(2 * w * a) / (2 * w))
+    wx = np.outer(x, w)
+    return np.where(even, np.cos(wx), np.sin(wx)) * coe
+
+def Exponential_Gaussian_RF_KL(grid, J, l, a, seed=24):
     '''
     Sample by KL expansion of random fields.
     Input:
@@ -444,23 +1303,254 @@ def Exponential_Gaussian_RF_KL(grid, J, l, a):
         J: number of truncated terms
         l: param for exponential covariance function
         a: space domain [-a, a]
+        seed: random seed
     Output:
         random field value
     '''
-    w = root_w(J, l, a)
+    w = Root_W(J, l, a)
     v = eigen_v(w, l)
-    x1 = grid[:, 0]; x2 = grid[:, 1]
-    np.random.seed(24)
+    np.random.seed(seed)
     xi = np.random.randn(J)
-    Phi = []
-    for i in range(J):
-        phix1 = phi(x1, i, w, a)
-        phix2 = phi(x2, i, w, a)
-        Phi.append(phix1 * phix2)
-    Phi = np.array(Phi).T
-    return np.sum(Phi * v**(0.5) * xi, 1)
+    Phi = Phi_Matrix(grid[:, 0], w, a) * Phi_Matrix(grid[:, 1], w, a)
+    return np.dot(Phi, v**(0.5) * xi)
+
+_KL_RF_CACHE = LRU_Cache(16)
+
+class Exponential_KL_RF:
+    '''
+    KL expansion of the Gaussian random field on [-a, a]^2 with separable exponential covariance
+    exp(-|x1 - y1|/l - |x2 - y2|/l). The eigenpairs are the products nu_i nu_j, phi_i(x1) phi_j(x2)
+    of the 1D ones, the modes are cached on (J, l, a).
+    Input:
+        J: number of 1D modes in each direction, J^2 terms in total
+        l: param for exponential covariance function
+        a: space domain [-a, a]
+    '''
+    def __init__(self, J, l, a):
+        self.J = J;    self.l = l;    self.a = a
+        def build():
+            w = Root_W(J, l, a)
+            return w, eigen_v(w, l)
+        self.w, self.nu = _KL_RF_CACHE.get((J, l, a), build)
+        self.S = np.sqrt(np.outer(self.nu, self.nu))
+
+    def sample(self, x1, x2, M=1, rng=None, sampler=None):
+        '''
+        Input:
+            x1, x2: coordinates of the tensor grid
+            M: number of samples
+            rng: Generator or seed, see Get_Rng
+            sampler: Point_Sampler (or its kind) of dimension J^2 giving the coefficients by inverse
+                     normal transform, its leading coordinates go to the largest eigenvalues nu_i nu_j
+        Output:
+            u: [M, x1.size, x2.size] samples, u[m, i, j] at (x1[i], x2[j])
+        '''
+        P1 = Phi_Matrix(np.asarray(x1, dtype=float), self.w, self.a)
+        P2 = Phi_Matrix(np.asarray(x2, dtype=float), self.w, self.a)
+        if sampler is None:
+            xi = Get_Rng(rng).standard_normal((M, self.J, self.J)) * self.S
+        else:
+            xi = np.empty((M, self.J**2))
+            xi[:, np.argsort(-self.S.ravel(), kind='stable')] = Get_Point_Sampler(sampler, self.J**2, rng).normal(M)[:, :self.J**2]
+            xi = xi.reshape(M, self.J, self.J) * self.S
+        # (xi P2^T) as one GEMM, then P1 on the left of each sample
+        C = (xi.reshape(M * self.J, self.J) @ P2.T).reshape(M, self.J, -1)
+        return np.matmul(P1, C)
 
 
+##############################################################################################
+# sparse FEM assembly
+class Sparse_Pattern:
+    '''
+    CSC sparsity pattern of a FEM matrix, with the position of every element contribution in the CSC data
+    array, so that assembling a matrix on the same mesh is a single bincount
+    Input:
+        elt2vert: [ne, nloc] vertices index of each element
+        nvtx: number of vertices
+    '''
+    def __init__(self, elt2vert, nvtx):
+        ne, nloc = elt2vert.shape
+        # COO triplets of all local pairs (i, j), in the order of Aks[:, i, j].ravel()
+        rows = np.repeat(elt2vert, nloc, axis=1).ravel()
+        cols = np.tile(elt2vert, (1, nloc)).ravel()
+        keys, self.map = np.unique(cols.astype('int64') * nvtx + rows, return_inverse=True)
+        self.map = self.map.ravel()
+        self.indices = (keys % nvtx).astype('int32')
+        self.indptr = np.searchsorted(keys // nvtx, np.arange(nvtx + 1)).astype('int32')
+        self.nnz = keys.size
+        self.shape = (nvtx, nvtx)
+
+    def assemble_data(self, Aks):
+        '''
+        CSC data array of the matrix with local matrices Aks [ne, nloc, nloc]
+        '''
+        return np.bincount(self.map, weights=np.ravel(Aks), minlength=self.nnz)
+
+    def assemble(self, Aks):
+        '''
+        the global matrix with local matrices Aks [ne, nloc, nloc]
+        '''
+        return sparse.csc_matrix((self.assemble_data(Aks), self.indices, self.indptr), shape=self.shape)
+
+    def sub_pattern(self, rows, cols):
+        '''
+        Sub_Pattern of the block A[rows, :][:, cols], rows and cols sorted
+        '''
+        nvtx = self.shape[0]
+        rmap = -np.ones(nvtx, dtype='int64');    rmap[rows] = np.arange(rows.size)
+        cmap = -np.ones(nvtx, dtype='int64');    cmap[cols] = np.arange(cols.size)
+        col_of_nz = np.repeat(np.arange(nvtx), np.diff(self.indptr))
+        sel = np.flatnonzero((rmap[self.indices] >= 0) & (cmap[col_of_nz] >= 0))
+        new_cols = cmap[col_of_nz[sel]]
+        indices = rmap[self.indices[sel]].astype('int32')
+        indptr = np.searchsorted(new_cols, np.arange(cols.size + 1)).astype('int32')
+        return Sub_Pattern(sel, indices, indptr, (rows.size, cols.size))
+
+class Sub_Pattern:
+    '''
+    A block of a Sparse_Pattern, maps the CSC data of the full matrix to the CSC data of the block
+    Input:
+        sel: positions of the block entries in the full data array
+        indices, indptr: CSC structure of the block
+        shape: shape of the block
+    '''
+    def __init__(self, sel, indices, indptr, shape):
+        self.sel = sel;    self.indices = indices;    self.indptr = indptr;    self.shape = shape
+
+    def matrix(self, data):
+        '''
+        the block as a csc matrix, from the data array of the full matrix
+        '''
+        return sparse.csc_matrix((data[self.sel], self.indices, self.indptr), shape=self.shape)
+
+_PATTERN_CACHE = LRU_Cache(8)
+
+def Get_Sparse_Pattern(elt2vert, nvtx):
+    '''
+    Sparse_Pattern of the mesh, cached on the connectivity
+    '''
+    elt2vert = np.ascontiguousarray(elt2vert)
+    key = (nvtx, elt2vert.shape, elt2vert.tobytes())
+    return _PATTERN_CACHE.get(key, lambda: Sparse_Pattern(elt2vert, nvtx))
+
+def Assemble_Matrix(elt2vert, Aks, nvtx):
+    '''
+    Assemble the global sparse matrix from element matrices in one pass
+    Input:
+        elt2vert: [ne, nloc] vertices index of each element
+        Aks: [ne, nloc, nloc] element matrices
+        nvtx: number of vertices
+    Output:
+        A: [nvtx, nvtx] csc matrix
+    '''
+    return Get_Sparse_Pattern(elt2vert, nvtx).assemble(Aks)
+
+def Assemble_Vector(elt2vert, bks, nvtx):
+    '''
+    Assemble the global vector from element vectors bks [ne, nloc]
+    '''
+    return np.bincount(np.ravel(elt2vert), weights=np.ravel(bks), minlength=nvtx)
+
+##############################################################################################
+# iterative solvers for SPD FEM systems
+import warnings
+
+def Preconditioner(A, kind='ic', drop_tol=1e-4, fill_factor=10, omega=1.0):
+    '''
+    Build a symmetric positive definite preconditioner once, typically from the mean-coefficient
+    operator, to be reused for every sample
+    Input:
+        A: sparse SPD matrix
+        kind: 'jacobi' for the diagonal, 'ssor' for symmetric successive over-relaxation,
+              'ic' for an incomplete Cholesky factorization L D L^T, 'lu' for the complete
+              factorization of A, 'amg' for algebraic multigrid (needs pyamg)
+        drop_tol, fill_factor: parameters of the incomplete factorization
+        omega: relaxation parameter of 'ssor' in (0, 2), symmetric Gauss-Seidel for 1
+    Output:
+        M: function r -> M^{-1} r
+    '''
+    kind = kind.lower()
+    if kind == 'jacobi':
+        dinv = 1 / A.diagonal()
+        return lambda r: dinv * r
+    if kind == 'ssor':
+        A = sparse.csr_matrix(A)
+        d = A.diagonal()
+        lower = sparse.csr_matrix(sparse.tril(A, -1) * omega + sparse.diags(d))
+        upper = sparse.csr_matrix(lower.T)
+        scale = omega * (2 - omega)
+        solve = sparse.linalg.spsolve_triangular
+        return lambda r: scale * solve(upper, d * solve(lower, r, lower=True), lower=False)
+    if kind == 'ic':
+        # without reordering and pivoting the incomplete LU of a symmetric matrix has U ~ D L^T,
+        # only L and D are kept so that M = L D L^T is exactly symmetric
+        n = A.shape[0]
+        ilu = sparse.linalg.spilu(sparse.csc_matrix(A), drop_tol=drop_tol, fill_factor=fill_factor,
+                                  permc_spec='NATURAL', diag_pivot_thresh=0, options={'SymmetricMode': True})
+        if np.any(ilu.perm_r != np.arange(n)) or np.any(ilu.perm_c != np.arange(n)):
+            raise RuntimeError("the incomplete factorization was reordered, use kind='ssor' instead")
+        d = ilu.U.diagonal()
+        if np.any(d <= 0):
+            raise ValueError("incomplete Cholesky breakdown, use kind='ssor' or a smaller drop_tol")
+        lower = sparse.csr_matrix(ilu.L)
+        upper = sparse.csr_matrix(lower.T)
+        solve = sparse.linalg.spsolve_triangular
+        return lambda r: solve(upper, solve(lower, r, lower=True, unit_diagonal=True) / d,
+                               lower=False, unit_diagonal=True)
+    if kind == 'lu':
+        return sparse.linalg.splu(sparse.csc_matrix(A)).solve
+    if kind == 'amg':
+        try:
+            import pyamg
+        except ImportError:
+            raise ImportError("kind='amg' needs pyamg, use 'ic' or 'ssor' instead")
+        ml = pyamg.smoothed_aggregation_solver(sparse.csr_matrix(A))
+        return lambda r: ml.solve(r, tol=1e-12, maxiter=1, cycle='V')
+    raise ValueError(f'unknown preconditioner {kind}')
+
+def PCG(A, b, M=None, x0=None, tol=1e-10, maxiter=None):
+    '''
+    Preconditioned conjugate gradient method for SPD systems
+    Input:
+        A: sparse SPD matrix
+        b: right-hand side
+        M: preconditioner r -> M^{-1} r, see Preconditioner
+        x0: initial guess, e.g. the solution of the previous sample
+        tol: tolerance on the relative residual |b - Ax| / |b|
+        maxiter: maximum number of iterations, 10 * b.size by default
+    Output:
+        x: solution, a RuntimeWarning is issued if tol is not reached
+        it: number of iterations
+    '''
+    maxiter = 10 * b.size if maxiter is None else maxiter
+    x = np.zeros_like(b, dtype=float) if x0 is None else np.array(x0, dtype=float)
+    r = b - A @ x
+    bnorm = np.linalg.norm(b)
+    if bnorm == 0:
+        return np.zeros_like(x), 0
+    z = r if M is None else M(r)
+    p = np.copy(z)
+    rz = r @ z
+    for it in range(maxiter):
+        if np.linalg.norm(r) <= tol * bnorm:
+            return x, it
+        Ap = A @ p
+        pAp = p @ Ap
+        if pAp <= 0 or rz <= 0:
+            warnings.warn(f'PCG breakdown after {it} iterations, A or M is not SPD', RuntimeWarning)
+            return x, it
+        alpha = rz / pAp
+        x += alpha * p
+        r -= alpha * Ap
+        z = r if M is None else M(r)
+        rz_new = r @ z
+        p = z + (rz_new / rz) * p
+        rz = rz_new
+    res = np.linalg.norm(r) / bnorm
+    if res > tol:
+        warnings.warn(f'PCG reached maxiter = {maxiter} with relative residual {res:.2e} > tol = {tol:.2e}', RuntimeWarning)
+    return x, maxiter
+
 ##############################################################################################
 # 1D stationary FEM
 def Get_Ele_Info(h, p, q, f, ne):
@@ -506,12 +1596,9 @@ def FEM_Solver1D_r1(ne, p, q, f):
     nvtx = ne + 1
     Kks, Mks, bks = Get_Ele_Info(h, p, q, f, ne)
     elt2vert = np.vstack((np.arange(0, nvtx - 1, dtype = 'int'), np.arange(1, nvtx, dtype = 'int')))
-    b = np.zeros(nvtx)
-    K = sum(sparse.csc_matrix((Kks[:, row_no, col_no], (elt2vert[row_no, :], elt2vert[col_no, :])), (nvtx, nvtx)) for row_no in range(2)  for col_no in range(2))
-    M = sum(sparse.csc_matrix((Mks[:, row_no, col_no], (elt2vert[row_no, :], elt2vert[col_no, :])), (nvtx, nvtx)) for row_no in range(2)  for col_no in range(2))
-    for row_no in range(2):
-        nrow = elt2vert[row_no, :]
-        b[nrow] = b[nrow] + bks[:, row_no]
+    K = Assemble_Matrix(elt2vert.T, Kks, nvtx)
+    M = Assemble_Matrix(elt2vert.T, Mks, nvtx)
+    b = Assemble_Vector(elt2vert.T, bks, nvtx)
     A = K + M
     # impose homogeneous boundary condition
     A = A[1:-1, 1:-1]; K = K[1:-1, 1:-1]; M = M[1:-1, 1:-1]
@@ -598,6 +1685,108 @@ def Get_Jacobian_Info(xv, yv, ne, elt2vert):
     invJks[:, 1, 1] = (x2 - x1)/detJks
     return Jks, invJks, detJks
 
+class Mesh:
+    '''
+    Triangular mesh with cached geometry, boundary/interior index sets, sparsity pattern and the
+    reduction of assembled matrices to the interior degrees of freedom
+    Input:
+        xv, yv: x, y value of grid points
+        elt2vert: vertices index of each triangular element
+        b_nodes: Dirichlet boundary vertices, the boundary of the unit square by default
+    '''
+    def __init__(self, xv, yv, elt2vert, b_nodes=None):
+        self.xv = xv;    self.yv = yv;    self.elt2vert = elt2vert
+        self.nvtx = xv.size;    self.ne = elt2vert.shape[0]
+        self.Jks, self.invJks, self.detJks = Get_Jacobian_Info(xv, yv, self.ne, elt2vert)
+        if b_nodes is None:
+            b_nodes = np.where((xv == 0) | (xv == 1) | (yv == 0) | (yv == 1))[0]
+        self.b_nodes = np.unique(b_nodes)
+        int_mask = np.ones(self.nvtx, dtype='bool');    int_mask[self.b_nodes] = False
+        self.int_nodes = np.flatnonzero(int_mask)
+        # geometric part of the local stiffness matrices and load vectors, linear nodal basis
+        dpsi = np.array([[-1, 1, 0], [-1, 0, 1]])
+        grads = np.matmul(self.invJks, dpsi)
+        self.Kgeom = self.detJks[:, None, None] * np.einsum('eki,ekj->eij', grads, grads) / 2
+        self.bgeom = np.repeat(self.detJks[:, None] / 6, 3, axis=1)
+        self._setup()
+
+    def _setup(self):
+        self.pattern = Get_Sparse_Pattern(self.elt2vert, self.nvtx)
+        self.int_int = self.pattern.sub_pattern(self.int_nodes, self.int_nodes)
+        self.int_bnd = self.pattern.sub_pattern(self.int_nodes, self.b_nodes)
+        # CSC data of the stiffness matrix is linear in the element coefficient a: data = G a
+        ne, nloc = self.elt2vert.shape
+        elem = np.repeat(np.arange(ne), nloc * nloc)
+        G = sparse.csr_matrix((np.ravel(self.Kgeom), (self.pattern.map, elem)), shape=(self.pattern.nnz, ne))
+        self.G_int = G[self.int_int.sel];    self.G_bnd = G[self.int_bnd.sel]
+        self._system = None
+
+    @classmethod
+    def uniform(cls, ns):
+        '''
+        the mesh of Uniform_Mesh(ns)
+        '''
+        h, xv, yv, elt2vert, nvtx, ne = Uniform_Mesh(ns)
+        mesh = cls(xv, yv, elt2vert)
+        mesh.ns = ns;    mesh.h = h
+        return mesh
+
+    def reduce(self, data):
+        '''
+        Input:
+            data: CSC data array of a matrix assembled on the mesh
+        Output:
+            A_int: interior block
+            A_b: interior-boundary block
+        '''
+        return self.int_int.matrix(data), self.int_bnd.matrix(data)
+
+    def stiffness(self, a, inplace=False):
+        '''
+        Interior blocks of the stiffness matrix of the element-wise coefficient a, one sparse
+        matrix-vector product per block
+        Input:
+            a: coefficient on each element
+            inplace: overwrite the data of the matrices returned by the previous inplace call
+                     instead of building new ones
+        Output:
+            A_int: interior block
+            A_b: interior-boundary block
+        '''
+        a = np.broadcast_to(a, (self.ne,))
+        if inplace and self._system is not None:
+            A_int, A_b = self._system
+            A_int.data[:] = self.G_int @ a;    A_b.data[:] = self.G_bnd @ a
+            return A_int, A_b
+        A_int = sparse.csc_matrix((self.G_int @ a, self.int_int.indices, self.int_int.indptr), shape=self.int_int.shape)
+        A_b = sparse.csc_matrix((self.G_bnd @ a, self.int_bnd.indices, self.int_bnd.indptr), shape=self.int_bnd.shape)
+        if inplace:
+            self._system = (A_int, A_b)
+        return A_int, A_b
+
+    def load(self, f):
+        '''
+        global load vector of the element-wise source f
+        '''
+        return Assemble_Vector(self.elt2vert, np.broadcast_to(f, (self.ne,))[:, None] * self.bgeom, self.nvtx)
+
+class Mesh1D(Mesh):
+    '''
+    Uniform mesh of [0, a] with ne linear elements and Dirichlet boundary at both ends, the same
+    interface as Mesh
+    Input:
+        ne: number of elements
+        a: space domain [0, a]
+    '''
+    def __init__(self, ne, a=1):
+        self.ne = ne;    self.nvtx = ne + 1;    self.h = a / ne
+        self.x = np.linspace(0, a, ne + 1)
+        self.elt2vert = np.vstack([np.arange(0, ne), np.arange(1, ne + 1)]).T
+        self.b_nodes = np.array([0, ne]);    self.int_nodes = np.arange(1, ne)
+        self.Kgeom = np.broadcast_to(np.array([[1, -1], [-1, 1]]) / self.h, (ne, 2, 2))
+        self.bgeom = np.full((ne, 2), self.h / 2)
+        self._setup()
+
 def Get_Integration_Info_r1(ne, invJks, detJks, a, f):
     '''
     Collection of local matrix on each element using linear nodal basis.
@@ -625,7 +1814,7 @@ def Get_Integration_Info_r1(ne, invJks, detJks, a, f):
         bk[:,i]=bk[:,i] + f*detJks / 6
     return Ak, bk
 
-def FEM_Solver2D_r1(ns, xv, yv, elt2vert, nvtx, ne, a, f):
+def FEM_Solver2D_r1(ns, xv, yv, elt2vert, nvtx, ne, a, f, mesh=None, inplace=False, solver='direct', M=None, x0=None, tol=1e-10):
     '''
     2D FEM solver
     Input:
@@ -636,32 +1825,37 @@ def FEM_Solver2D_r1(ns, xv, yv, elt2vert, nvtx, ne, a, f):
         ne: number of elements(2*ns^2)
         a: spatial domain [0, a]
         f: source term f(x)
+        mesh: prebuilt Mesh of (xv, yv, elt2vert), reused across calls
+        inplace: update the interior matrices of the mesh in place, see Mesh.stiffness
+        solver: 'direct' for sparse LU, 'cg' for preconditioned conjugate gradient
+        M: preconditioner for solver = 'cg', a function or a kind of Preconditioner built from A_int
+        x0: initial guess of u_int for solver = 'cg'
+        tol: relative residual tolerance for solver = 'cg', a RuntimeError is raised if it is not met
     Output:
         uh: solution of u
         u_int: solution on inner points
         A_int: inner part of A
         rhs: inner part of b
     '''
-    Jks, invJks, detJks = Get_Jacobian_Info(xv, yv, ne, elt2vert)
-    Aks, bks = Get_Integration_Info_r1(ne, invJks, detJks, a, f)
-    A = sparse.csc_matrix((nvtx, nvtx))
-    A = sum(sparse.csc_matrix((Aks[:, row_no, col_no], (elt2vert[:, row_no], elt2vert[:, col_no])), (nvtx, nvtx)) for row_no in range(3)  for col_no in range(3))
-    b = np.zeros(nvtx)
-    for k in range(3):
-        nrow = elt2vert[:, k]
-        b[nrow] = b[nrow] + bks[:, k]
+    if mesh is None:
+        mesh = Mesh(xv, yv, elt2vert)
+    b_nodes = mesh.b_nodes;    int_nodes = mesh.int_nodes
+    A_int, Ab = mesh.stiffness(a, inplace)
+    b_int = mesh.load(f)[int_nodes]
     # get discrete Dirichlet boundary data 
-    b_nodes = np.where((xv == 0) | (xv == 1) | (yv == 0) | (yv == 1))[0]
-    int_nodes = np.ones(nvtx, dtype='bool');    
-    int_nodes[b_nodes]=False;    
-    b_int = np.squeeze(b[int_nodes])
-    # print(b_int)
     wB = g_eval(xv[b_nodes], yv[b_nodes])
     # solve linear system for interior nodes;
-    Ab = A[int_nodes, :]; Ab = Ab[:, b_nodes]
     rhs = b_int - Ab.dot(wB)
-    A_int = A[int_nodes, :]; A_int=A_int[:, int_nodes]
-    u_int = sparse.linalg.spsolve(A_int,rhs)
+    if solver == 'cg':
+        if isinstance(M, str):
+            M = Preconditioner(A_int, M)
+        u_int, it = PCG(A_int, rhs, M, x0, tol)
+        res = np.linalg.norm(rhs - A_int @ u_int)
+        if res > tol * np.linalg.norm(rhs):
+            raise RuntimeError(f'PCG did not converge after {it} iterations, relative residual '
+                               f'{res / np.linalg.norm(rhs):.2e}, use a stronger preconditioner')
+    else:
+        u_int = sparse.linalg.spsolve(A_int,rhs)
     # combine with boundary data and plot
     uh = np.zeros(nvtx)
     uh[int_nodes] = u_int
@@ -678,9 +1872,213 @@ def g_eval(x,y):
     g=np.zeros(x.shape)
     return g      
 
+##############################################################################################
+# stiff time integrators for semilinear problems u_t = L u + N(u)
+# IMEX Runge-Kutta tableaux of Ascher, Ruuth & Spiteri: implicit A, b then explicit A, b
+_ARS_G2 = 1 - 1 / sqrt(2);    _ARS_D2 = 1 - 1 / (2 * _ARS_G2);    _ARS_G3 = 0.4358665215
+IMEX_TABLEAUX = {
+    'ars222': (np.array([[0, 0, 0], [0, _ARS_G2, 0], [0, 1 - _ARS_G2, _ARS_G2]]),
+               np.array([0, 1 - _ARS_G2, _ARS_G2]),
+               np.array([[0, 0, 0], [_ARS_G2, 0, 0], [_ARS_D2, 1 - _ARS_D2, 0]]),
+               np.array([_ARS_D2, 1 - _ARS_D2, 0])),
+    'ars343': (np.array([[0, 0, 0, 0], [0, _ARS_G3, 0, 0], [0, 0.2820667392, _ARS_G3, 0],
+                         [0, 1.208496649, -0.644363171, _ARS_G3]]),
+               np.array([0, 1.208496649, -0.644363171, _ARS_G3]),
+               np.array([[0, 0, 0, 0], [_ARS_G3, 0, 0, 0], [0.3212788860, 0.3966543747, 0, 0],
+                         [-0.105858296, 0.5529291479, 0.5529291479, 0]]),
+               np.array([0, 1.208496649, -0.644363171, _ARS_G3])),
+}
+
+def Phi_Functions(z, m=32):
+    '''
+    phi_1(z) = (e^z - 1)/z, phi_2(z) = (e^z - 1 - z)/z^2, phi_3(z) = (e^z - 1 - z - z^2/2)/z^3 by the
+    mean over a circle of radius 1 around every z (Kassam & Trefethen), free of cancellation near z = 0
+    Input:
+        z: array of real arguments
+        m: number of points on the circle
+    Output:
+        phi1, phi2, phi3
+    '''
+    r = np.exp(1j * pi * (np.arange(1, m + 1) - 0.5) / m)
+    LR = np.asarray(z)[..., None] + r
+    eLR = np.exp(LR)
+    phi1 = np.real(np.mean((eLR - 1) / LR, axis=-1))
+    phi2 = np.real(np.mean((eLR - 1 - LR) / LR**2, axis=-1))
+    phi3 = np.real(np.mean((eLR - 1 - LR - LR**2 / 2) / LR**3, axis=-1))
+    return phi1, phi2, phi3
+
+_STEPPER_CACHE = LRU_Cache(16)
+
+class Semilinear_Stepper:
+    '''
+    One time step of u_t = L u + N(u), the coefficients (exponentials, phi-functions, factorized
+    implicit operators) are computed once per (scheme, Dt, key)
+    Input:
+        L: diagonal of L as an array (spectral Galerkin) or a sparse matrix (finite differences)
+        Dt: time step
+        scheme: 'euler' for semi-implicit Euler; 'etd1', 'etdrk2', 'etdrk4' for exponential time
+                differencing (diagonal L only); 'ars222', 'ars343' for the IMEX Runge-Kutta schemes
+                of order 2 and 3
+        nonlinear: function v -> N(v) evaluated at the inner stages
+        key: hashable description of L (method, grid, parameters) for the cache, no caching if None
+        M: sparse mass matrix of M u_t = L u + N(u) (finite elements), identity if None; only for
+           scheme = 'euler'
+    '''
+    def __init__(self, L, Dt, scheme, nonlinear, key=None, M=None):
+        self.scheme = scheme.lower()
+        self.Dt = Dt
+        self.N = nonlinear
+        self.M = M
+        self.diagonal = not sparse.issparse(L)
+        if M is not None and self.scheme != 'euler':
+            raise ValueError(f'scheme {self.scheme} does not take a mass matrix')
+        if key is None:
+            self.coef = self._coefficients(L)
+        else:
+            self.coef = _STEPPER_CACHE.get((self.scheme, Dt, key), lambda: self._coefficients(L))
+
+    def _implicit(self, L, g):
+        '''
+        solver of (I - g L) x = rhs
+        '''
+        if self.diagonal:
+            EE = 1 / (1 - g * L)
+            return lambda rhs: EE * rhs
+        M = sparse.identity(L.shape[0], format='csc') if self.M is None else self.M
+        return sparse.linalg.factorized(sparse.csc_matrix(M - g * L))
+
+    def _coefficients(self, L):
+        Dt = self.Dt
+        if self.scheme == 'euler':
+            return {'solve': self._implicit(L, Dt)}
+        if self.scheme in IMEX_TABLEAUX:
+            Ai = IMEX_TABLEAUX[self.scheme][0]
+            return {'L': L, 'solves': {g: self._implicit(L, Dt * g) for g in set(np.diag(Ai)) - {0}}}
+        if not self.diagonal:
+            raise ValueError(f'scheme {self.scheme} needs a diagonal linear operator')
+        z = Dt * L
+        phi1, phi2, phi3 = Phi_Functions(z)
+        if self.scheme == 'etd1':
+            return {'E': np.exp(z), 'f1': Dt * phi1}
+        if self.scheme == 'etdrk2':
+            return {'E': np.exp(z), 'f1': Dt * phi1, 'f2': Dt * phi2}
+        if self.scheme == 'etdrk4':
+            return {'E': np.exp(z), 'E2': np.exp(z / 2), 'Q': Dt / 2 * Phi_Functions(z / 2)[0],
+                    'f1': Dt * (phi1 - 3 * phi2 + 4 * phi3), 'f2': Dt * (phi2 - 2 * phi3), 'f3': Dt * (4 * phi3 - phi2)}
+        raise ValueError(f'unknown scheme {self.scheme}')
+
+    def __call__(self, v, Nv=None):
+        '''
+        Input:
+            v: current value
+            Nv: N(v) if already available
+        Output:
+            value after one step
+        '''
+        c = self.coef;    N = self.N
+        Nv = N(v) if Nv is None else Nv
+        if self.scheme == 'euler':
+            return c['solve']((v if self.M is None else self.M @ v) + self.Dt * Nv)
+        if self.scheme == 'etd1':
+            return c['E'] * v + c['f1'] * Nv
+        if self.scheme == 'etdrk2':
+            a = c['E'] * v + c['f1'] * Nv
+            return a + c['f2'] * (N(a) - Nv)
+        if self.scheme == 'etdrk4':
+            a = c['E2'] * v + c['Q'] * Nv;          Na = N(a)
+            b = c['E2'] * v + c['Q'] * Na;          Nb = N(b)
+            d = c['E2'] * a + c['Q'] * (2 * Nb - Nv);   Nd = N(d)
+            return c['E'] * v + c['f1'] * Nv + 2 * c['f2'] * (Na + Nb) + c['f3'] * Nd
+        Ai, bi, Ae, be = IMEX_TABLEAUX[self.scheme]
+        L = c['L'];    s = bi.size;    Dt = self.Dt
+        KI = [None] * s;    KE = [None] * s
+        for i in range(s):
+            U = v
+            for j in range(i):
+                if Ae[i, j] != 0:
+                    U = U + (Dt * Ae[i, j]) * KE[j]
+                if Ai[i, j] != 0:
+                    U = U + (Dt * Ai[i, j]) * KI[j]
+            if Ai[i, i] != 0:
+                U = c['solves'][Ai[i, i]](U)
+            # stage terms are only formed when a later stage or the update uses them
+            if i == 0:
+                KE[0] = Nv
+            elif be[i] != 0 or np.any(Ae[i + 1:, i]):
+                KE[i] = N(U)
+            if bi[i] != 0 or np.any(Ai[i + 1:, i]):
+                KI[i] = L * U if self.diagonal else L @ U
+        for j in range(s):
+            if be[j] != 0:
+                v = v + (Dt * be[j]) * KE[j]
+            if bi[j] != 0:
+                v = v + (Dt * bi[j]) * KI[j]
+        return v
+
+def Adaptive_Semilinear(L, nonlinear, v0, T, t_out, tol, Dt0, key=None, M=None, norm=None, maxsize=8):
+    '''
+    Semi-implicit Euler for M u_t = L u + N(u) with step-doubling error control: every step of size
+    Dt is compared with two steps of size Dt/2, which are kept. Dt stays in Dt0 * 2^k (apart from
+    the last step) so that the factorized operators M - Dt L are reused from an LRU cache.
+    Input:
+        L, nonlinear, key, M: see Semilinear_Stepper
+        v0: initial value
+        T: time domain [0, T]
+        t_out: output times in [0, T], increasing
+        tol: tolerance on the local error, relative to max(1, norm(v))
+        Dt0: initial time step
+        norm: norm of the local error, maximum modulus of v by default
+        maxsize: number of step sizes whose operators are kept
+    Output:
+        V: [t_out.size, ...] values at t_out by cubic Hermite interpolation between steps
+        t_steps: times of the accepted steps
+    '''
+    norm = norm or (lambda v: np.max(np.abs(v)))
+    steppers = LRU_Cache(maxsize)
+    get_step = lambda Dt: steppers.get(Dt, lambda: Semilinear_Stepper(L, Dt, 'euler', nonlinear, key, M))
+    Minv = None if M is None else sparse.linalg.factorized(sparse.csc_matrix(M))
+    def deriv(v, Nv):
+        rhs = (L * v if not sparse.issparse(L) else L @ v) + Nv
+        return rhs if Minv is None else Minv(rhs)
+    t_out = np.asarray(t_out, dtype=float)
+    if t_out.size and (t_out[0] < 0 or t_out[-1] > T or np.any(np.diff(t_out) < 0)):
+        raise ValueError(f't_out must be increasing in [0, T] = [0, {T}]')
+    V = np.zeros((t_out.size,) + np.shape(v0), dtype=np.asarray(v0).dtype)
+    iout = np.searchsorted(t_out, 0, side='right')
+    V[:iout] = v0
+    t = 0;    v = v0;    Nv = nonlinear(v);    dv = deriv(v, Nv)
+    k = 0;    t_steps = [0.0]
+    while T - t > 1e-12 * T:
+        Dt = Dt0 * 2.0**k
+        if t + Dt >= T * (1 - 1e-12):
+            Dt = T - t
+        if k < -50:
+            raise RuntimeError(f'step size underflow at t = {t}')
+        y1 = get_step(Dt)(v, Nv)
+        half = get_step(Dt / 2)
+        y = half(v, Nv)
+        y2 = half(y, nonlinear(y))
+        err = norm(y2 - y1) / max(1, norm(y2))
+        if err > tol:
+            k -= 1
+            continue
+        N2 = nonlinear(y2);    d2 = deriv(y2, N2)
+        t_new = t + Dt
+        while iout < t_out.size and t_out[iout] <= t_new + 1e-12 * T:
+            s = (t_out[iout] - t) / Dt
+            V[iout] = ((2*s**3 - 3*s**2 + 1) * v + (s**3 - 2*s**2 + s) * Dt * dv
+                       + (3*s**2 - 2*s**3) * y2 + (s**3 - s**2) * Dt * d2)
+            iout += 1
+        t, v, Nv, dv = t_new, y2, N2, d2
+        t_steps.append(t)
+        # the local error of Euler is O(Dt^2), doubling Dt multiplies it by about 4
+        if err < tol / 8:
+            k += 1
+    return V, np.array(t_steps)
+
 ##############################################################################################
 # Time-dependent PDE
-def Pde_MOL_FDM_1D_Semilinear(u0, T, a, N, J, epsilon, fhandle, bctype):
+def Pde_MOL_FDM_1D_Semilinear(u0, T, a, N, J, epsilon, fhandle, bctype, scheme='euler', tol=None, t_out=None):
     '''
     Solve semilinear PDE with method of line for time and FDM for space
     Input:
@@ -692,6 +2090,10 @@ def Pde_MOL_FDM_1D_Semilinear(u0, T, a, N, J, epsilon, fhandle, bctype):
         epsilon: param of semilinear PDE
         fhandle: nonlinear term f(u)
         bdtype: 'd' for Dirichlet; 'p' for Period; 'n' for Nuemann
+        scheme: 'euler', 'ars222' or 'ars343', see Semilinear_Stepper
+        tol: adaptive semi-implicit Euler with this local error tolerance and initial step T / N
+             instead of N fixed steps, see Adaptive_Semilinear; needs scheme = 'euler'
+        t_out: output times of the adaptive solver, the N + 1 uniform times by default
     Ouput:
         t, x: time grids and space grids
         ut: [J + 1, N + 1] space-time solution
@@ -710,25 +2112,36 @@ def Pde_MOL_FDM_1D_Semilinear(u0, T, a, N, J, epsilon, fhandle, bctype):
         if 'p' == bctype.lower():
             ind = np.arange(0, J)
             A = A[:, ind]; A = A[ind, :]
-            A[1, -1] = -1; A[-1, 1] = -1
+            A[0, -1] = -1; A[-1, 0] = -1
         elif 'n' == bctype.lower():
             ind = np.arange(0, J + 1)
             A[0, 1] = -2; A[-1, -2] = -2 
-    EE = scipy.sparse.identity(ind.size, format = 'csc') + (Dt * epsilon/h**2) * A 
+    L = (- epsilon/h**2) * A
+    key = ('fdm', a, J, epsilon, bctype.lower())
+    if tol is not None:
+        if scheme.lower() != 'euler':
+            raise ValueError(f"tol needs scheme = 'euler', the adaptive solver is semi-implicit Euler, got {scheme}")
+        t = t if t_out is None else np.asarray(t_out, dtype=float)
+        ut = np.zeros((J + 1, t.size))
+        ut[ind, :] = Adaptive_Semilinear(L, fhandle, u0[ind], T, t, tol, Dt, key)[0].T
+        if t.size and t[0] == 0:
+            ut[:, 0] = u0
+        if bctype.lower() == 'p':
+            ut[-1, :] = ut[0, :]
+        return t, x, ut
     ut = np.zeros((J + 1, t.size)) # initialize vectors
     ut[:, 0] = u0; u_n = u0[ind] # set initial condition
     #
-    EEinv = sparse.linalg.factorized(EE)
+    step = Semilinear_Stepper(L, Dt, scheme, fhandle, key)
     #
     for k in range(N): # time loop
-        fu = fhandle(u_n) # evaluate f(u_n)
-        u_n = EEinv(u_n + Dt * fu) # linear solve for EE
+        u_n = step(u_n) # (I - Dt L)^{-1}(u_n + Dt f(u_n)) for scheme = 'euler'
         ut[ind, k + 1] = u_n
     if bctype.lower() == 'p':
         ut[-1, :] = ut[0, :] # correct for periodic case  
     return t, x, ut
 
-def Pde_MOL_Galerkin_1D_Semilinear(u0, T, a, N, J, epsilon, fhandle):
+def Pde_MOL_Galerkin_1D_Semilinear(u0, T, a, N, J, epsilon, fhandle, scheme='euler', tol=None, t_out=None):
     """
     Use semi-implicit Euler method plus Galerkin method to solve 1d semilinear equation with periodic boundary
     Input:
@@ -739,6 +2152,10 @@ def Pde_MOL_Galerkin_1D_Semilinear(u0, T, a, N, J, epsilon, fhandle):
         J: number of space intervals
         epsilon: param of semilinear equation
         fhandle: nonlinear term f(u)
+        scheme: 'euler', 'etd1', 'etdrk2', 'etdrk4', 'ars222' or 'ars343', see Semilinear_Stepper
+        tol: adaptive semi-implicit Euler with this local error tolerance and initial step T / N
+             instead of N fixed steps, see Adaptive_Semilinear; needs scheme = 'euler'
+        t_out: output times of the adaptive solver, the N + 1 uniform times by default
     Output:
         t, x: time grids and space grids
         ut: [J + 1, N + 1] space-time solution
@@ -747,21 +2164,33 @@ def Pde_MOL_Galerkin_1D_Semilinear(u0, T, a, N, J, epsilon, fhandle):
     t = np.linspace(0, T, N+1)
     x = np.linspace(0, a, J+1)
     ut = np.zeros((J + 1, N + 1))
-    # set linear operator 
-    lam = (2 * pi/ a) * np.hstack([np.arange(0, J / 2+1), np.arange(- J / 2 + 1, 0)]) 
+    # set linear operator on the half spectrum of the real field
+    lam = (2 * pi/ a) * np.arange(0, J // 2 + 1)
     M = epsilon * lam ** 2
-    EE = 1.0 / (1 + Dt * M) # diagonal of (1+ Dt M)^{-1}
-    ut[:, 0] = u0;    u = u0[0:J];     uh = fft(u) # set initial condition
+    nonlinear = lambda vh: rfft(fhandle(irfft(vh, J)))
+    if tol is not None:
+        if scheme.lower() != 'euler':
+            raise ValueError(f"tol needs scheme = 'euler', the adaptive solver is semi-implicit Euler, got {scheme}")
+        t = t if t_out is None else np.asarray(t_out, dtype=float)
+        Vh, _ = Adaptive_Semilinear(-M, nonlinear, rfft(u0[0:J]), T, t, tol, Dt, ('galerkin', a, J, epsilon),
+                                    norm=lambda vh: np.max(np.abs(irfft(vh, J))))
+        ut = np.zeros((J + 1, t.size))
+        ut[0:J, :] = irfft(Vh, J).T;    ut[J, :] = ut[0, :]
+        if t.size and t[0] == 0:
+            ut[:, 0] = u0
+        return t, x, ut
+    step = Semilinear_Stepper(-M, Dt, scheme, nonlinear, ('galerkin', a, J, epsilon))
+    ut[:, 0] = u0;    u = u0[0:J];     uh = rfft(u) # set initial condition
     #
     for n in range(0, N): # time loop
-        fhu = fft(fhandle(u)) # evaluate fhat(u)
-        uh = EE*(uh + Dt * fhu) # semi-implicit Euler step
-        u = np.real(ifft(uh))
+        fhu = rfft(fhandle(u)) # evaluate fhat(u)
+        uh = step(uh, fhu) # (1 + Dt M)^{-1}(uh + Dt fhu) for scheme = 'euler'
+        u = irfft(uh, J)
         ut[0:J, n + 1] = u
     ut[J, :] = ut[0, :] # make periodic
     return t, x, ut
 
-def Pde_MOL_Galerkin_2D_Semilinear(u0, T, a, N, J, epsilon, fhandle):
+def Pde_MOL_Galerkin_2D_Semilinear(u0, T, a, N, J, epsilon, fhandle, scheme='euler', tol=None, t_out=None):
     """
     Use semi-implicit Euler method plus Galerkin method to solve 2d semilinear equation with periodic boundary
     Input:
@@ -772,25 +2201,43 @@ def Pde_MOL_Galerkin_2D_Semilinear(u0, T, a, N, J, epsilon, fhandle):
         J: number of space intervals
         epsilon: param of semilinear equation
         fhandle: nonlinear term f(u)
+        scheme: 'euler', 'etd1', 'etdrk2', 'etdrk4', 'ars222' or 'ars343', see Semilinear_Stepper
+        tol: adaptive semi-implicit Euler with this local error tolerance and initial step T / N
+             instead of N fixed steps, see Adaptive_Semilinear; needs scheme = 'euler'
+        t_out: output times of the adaptive solver, the N + 1 uniform times by default
     Output:
         t, x: time grids and space grids
-        ut: [J + 1, N + 1] space-time solution
+        ut: [J[0] + 1, J[1] + 1, N + 1] space-time solution
     """
     Dt = T / N
     t = np.linspace(0, T, N+1)
-    x  =  np.linspace(0,  a,  J + 1)
+    x  =  [np.linspace(0,  a[0],  J[0] + 1), np.linspace(0,  a[1],  J[1] + 1)]
     ut = np.zeros((J[0] + 1, J[1] + 1, N+1))
-    # set linear operators
-    lambdax = (2*pi/a[0]) * np.hstack([np.arange(0, J[0] / 2+1), np.arange(- J[0] / 2 + 1, 0)])
-    lambday = (2*pi/a[1]) * np.hstack([np.arange(0, J[1] / 2+1), np.arange(- J[1] / 2 + 1, 0)])
+    # set linear operators, the last axis keeps the half spectrum of the real field
+    lambdax = (2*pi/a[0]) * np.hstack([np.arange(0, J[0] // 2+1), np.arange(- J[0] // 2 + 1, 0)])
+    lambday = (2*pi/a[1]) * np.arange(0, J[1] // 2 + 1)
     lambdaxx, lambdayy = np.meshgrid(lambdax, lambday, indexing = 'ij')
     M = epsilon * (lambdaxx ** 2 + lambdayy ** 2)
-    EE = 1.0 / (1 + Dt * M)
-    ut[:, :, 0] = u0;  u = u0[0:-1, 0:-1];  uh = fft2(u)# set initial data 
+    s = (J[0], J[1])
+    nonlinear = lambda vh: rfft2(fhandle(irfft2(vh, s)))
+    if tol is not None:
+        if scheme.lower() != 'euler':
+            raise ValueError(f"tol needs scheme = 'euler', the adaptive solver is semi-implicit Euler, got {scheme}")
+        t = t if t_out is None else np.asarray(t_out, dtype=float)
+        Vh, _ = Adaptive_Semilinear(-M, nonlinear, rfft2(u0[0:-1, 0:-1]), T, t, tol, Dt, ('galerkin', tuple(a), s, epsilon),
+                                    norm=lambda vh: np.max(np.abs(irfft2(vh, s))))
+        ut = np.zeros((J[0] + 1, J[1] + 1, t.size))
+        ut[0:J[0], 0:J[1], :] = np.moveaxis(irfft2(Vh, s), 0, -1)
+        ut[J[0], :, :] = ut[0, :, :];    ut[:, J[1], :] = ut[:, 0, :]
+        if t.size and t[0] == 0:
+            ut[:, :, 0] = u0
+        return t, x, ut
+    step = Semilinear_Stepper(-M, Dt, scheme, nonlinear, ('galerkin', tuple(a), s, epsilon))
+    ut[:, :, 0] = u0;  u = u0[0:-1, 0:-1];  uh = rfft2(u)# set initial data 
     for n in range(N): # time loop
-        fhu = fft2(fhandle(u)) # compute fhat
-        uh_new = EE*(uh + Dt * fhu)
-        u = np.real(ifft2(uh_new))
+        fhu = rfft2(fhandle(u)) # compute fhat
+        uh_new = step(uh, fhu)
+        u = irfft2(uh_new, s)
         ut[0:J[0], 0:J[1], n + 1] = u
         uh = uh_new
     ut[J[0], :, :] = ut[0, :, :]
@@ -819,7 +2266,7 @@ def oned_linear_FEM_b_r1(ne, h, f):
     b=b[1:-1]
     return b
 
-def Pde_MOL_FEM_1D_Semilinear_r1(u0, T, a, N, ne, epsilon, fhandle):
+def Pde_MOL_FEM_1D_Semilinear_r1(u0, T, a, N, ne, epsilon, fhandle, tol=None, t_out=None):
     """
     Use semi-implicit Euler method plus FEM with linear basis to solve 1d semilinear equation with dirichlet boundary
     Input:
@@ -830,6 +2277,9 @@ def Pde_MOL_FEM_1D_Semilinear_r1(u0, T, a, N, ne, epsilon, fhandle):
         ne: number of space intervals
         epsilon: param of semilinear equation
         fhandle: nonlinear term f(u)
+        tol: adaptive semi-implicit Euler with this local error tolerance and initial step T / N
+             instead of N fixed steps, see Adaptive_Semilinear
+        t_out: output times of the adaptive solver, the N + 1 uniform times by default
     Output:
         t, x: time grids and space grids
         ut: [nvtx, N + 1] space-time solution
@@ -840,6 +2290,14 @@ def Pde_MOL_FEM_1D_Semilinear_r1(u0, T, a, N, ne, epsilon, fhandle):
     q = 1
     f = 1
     x, uh, A, b, KK, MM = FEM_Solver1D_r1(ne, p, q, f)
+    if tol is not None:
+        t = t if t_out is None else np.asarray(t_out, dtype=float)
+        nonlinear = lambda v: oned_linear_FEM_b(ne, h, fhandle(np.hstack([0, v, 0])))
+        ut = np.zeros((nvtx, t.size))
+        ut[1:-1, :] = Adaptive_Semilinear(-KK, nonlinear, u0[1:-1], T, t, tol, Dt, ('fem', a, ne, epsilon), MM)[0].T
+        if t.size and t[0] == 0:
+            ut[:, 0] = u0
+        return t, x, ut
     EE = (MM + Dt * KK)
     # set initial condition
     ut=np.zeros((nvtx,N + 1))
@@ -857,7 +2315,7 @@ def Pde_MOL_FEM_1D_Semilinear_r1(u0, T, a, N, ne, epsilon, fhandle):
 ##############################################################################################
 # SPDE with random data
 # Monte Carlo Method
-def MC_FEM_1d(ne, sigma, mu, P, Q):
+def MC_FEM_1d(ne, sigma, mu, P, Q, rng=None, sampler=None):
     '''
     Input:
         ne: number of space intervals
@@ -865,58 +2323,289 @@ def MC_FEM_1d(ne, sigma, mu, P, Q):
         mu: the mean of a(x, w)
         P: number of truncated KL expansion of a(x)
         Q: number of MC methods
+        rng: Generator or seed, see Get_Rng
+        sampler: Point_Sampler (or its kind) of dimension P for quasi-Monte Carlo, i.i.d. uniforms if None
     '''
+    rng = Get_Rng(rng)
+    if sampler is not None:
+        sampler = Get_Point_Sampler(sampler, P, rng)
     h = 1 / ne
     nvtx = ne + 1
     x = np.arange(h/2, 1, h)
-    mean = 0
-    var = 0
+    mesh = Mesh1D(ne)
+    b = mesh.load(np.ones(ne))[mesh.int_nodes]
+    uh = np.zeros(nvtx)
+    stats = Running_Stats(nvtx)
     for i in range(Q):
-        xi = np.random.uniform(-1, 1, ne)
+        if sampler is None:
+            xi = rng.uniform(-1, 1, ne)
+        else:
+            xi = np.hstack([0, 2 * sampler.uniform(1)[0, :P] - 1])
         a = mu * np.ones(ne)
         for k in range(1, P+1):
             a = a + sigma * (k * pi)**(-2) * np.cos(x * k * pi) * xi[k]
-        _, uh, A, b, K, M = FEM_Solver1D_r1(ne, a, np.zeros(ne), np.ones(ne))
-        mean = mean + uh
-        var = var + uh**2
-    mean = mean / Q
-    var = (var - mean**2 * Q)/ (Q - 1)
-    return mean, var
+        A, _ = mesh.stiffness(a, inplace=True)
+        uh[mesh.int_nodes] = sparse.linalg.spsolve(A, b)
+        stats.update(uh)
+    return stats.mean, stats.var
 
-def MC_FEM_2D(ns, Q, l, alpha):
+def Thomas_Solve(lower, diag, upper, rhs):
+    '''
+    Solve many tridiagonal systems at once by the Thomas algorithm
+    Input:
+        lower: [Q, n] sub-diagonals, lower[:, 0] unused
+        diag: [Q, n] diagonals
+        upper: [Q, n] super-diagonals, upper[:, -1] unused
+        rhs: [Q, n] right-hand sides
+    Output:
+        u: [Q, n] solutions
+    '''
+    # work on [n, Q] arrays so that every step is a contiguous vector operation over the systems
+    a = np.ascontiguousarray(np.broadcast_to(lower, np.shape(rhs)).T)
+    b = np.ascontiguousarray(np.broadcast_to(diag, np.shape(rhs)).T)
+    c = np.ascontiguousarray(np.broadcast_to(upper, np.shape(rhs)).T)
+    d = np.array(np.asarray(rhs).T, dtype=float)
+    n = d.shape[0]
+    cp = np.empty_like(b)
+    cp[0] = c[0] / b[0];    d[0] = d[0] / b[0]
+    for i in range(1, n):
+        m = b[i] - a[i] * cp[i - 1]
+        cp[i] = c[i] / m
+        d[i] = (d[i] - a[i] * d[i - 1]) / m
+    for i in range(n - 2, -1, -1):
+        d[i] -= cp[i] * d[i + 1]
+    return d.T
+
+def FEM_1d_Batch_Solve(ne, sigma, mu, xi):
+    '''
+    Piecewise linear FEM solutions of -(a u')' = 1 on [0, 1] with the KL coefficients of MC_FEM_1d
+    Input:
+        ne: number of space intervals
+        sigma: param of diffusion coefficients
+        mu: the mean of a(x, w)
+        xi: [nb, P] random variables of the truncated KL expansion
+    Output:
+        uh: [nb, ne + 1] nodal values
+    '''
+    h = 1 / ne
+    x = np.arange(h/2, 1, h)
+    k = np.arange(1, xi.shape[1] + 1)
+    basis = sigma * (k[:, None] * pi)**(-2) * np.cos(np.outer(k, x) * pi)
+    a = mu + xi @ basis
+    # interior node j couples elements j-1 and j
+    uh = np.zeros((xi.shape[0], ne + 1))
+    uh[:, 1:-1] = Thomas_Solve(-a[:, :-1] / h, (a[:, :-1] + a[:, 1:]) / h, -a[:, 1:] / h, np.full((xi.shape[0], ne - 1), h))
+    return uh
+
+def MC_FEM_1d_Batch(ne, sigma, mu, P, Q, rng=None, batch=4096, tol=None, level=0.95, sampler=None):
+    '''
+    Batched version of MC_FEM_1d: the coefficients of a whole batch come from one product of the
+    cosine basis with the random variables, and all the tridiagonal systems are solved together
+    Input:
+        ne: number of space intervals
+        sigma: param of diffusion coefficients
+        mu: the mean of a(x, w)
+        P: number of truncated KL expansion of a(x)
+        Q: number of MC methods
+        rng: Generator or seed, see Get_Rng
+        batch: number of samples solved together
+        tol: stop after the first batch at which the confidence interval half-width of the mean is
+             below tol at every node, Q is then the maximal number of samples
+        level: confidence level of the interval
+        sampler: Point_Sampler (or its kind) of dimension P for quasi-Monte Carlo, i.i.d. uniforms if
+                 None; with a tolerance the interval is only indicative, the points are not independent
+    Output:
+        mean, var
+    '''
+    rng = Get_Rng(rng)
+    if sampler is not None:
+        sampler = Get_Point_Sampler(sampler, P, rng)
+    stats = Running_Stats(ne + 1)
+    for i0 in range(0, Q, batch):
+        nb = min(batch, Q - i0)
+        xi = rng.uniform(-1, 1, (nb, P)) if sampler is None else 2 * sampler.uniform(nb)[:, :P] - 1
+        stats.update_batch(FEM_1d_Batch_Solve(ne, sigma, mu, xi))
+        if tol is not None and np.max(stats.ci_halfwidth(level)) <= tol:
+            break
+    return stats.mean, stats.var
+
+_MC_SETUP_CACHE = LRU_Cache(4)
+
+def MC_FEM_2D_Setup(ns, l, alpha, solver='direct', precond='ic', with_sampler=True):
+    '''
+    Mesh, field sampler and preconditioner of MC_FEM_2D, cached so that repeated runs (and every
+    chunk handled by one worker process of Parallel_MC) build them once
+    Input:
+        with_sampler: build the field sampler, False when the fields come from elsewhere (the
+                      coarse level of MLMC_FEM_2D_Level)
+    Output:
+        mesh, sampler (None unless with_sampler), M (None unless solver = 'cg')
+    '''
+    def build():
+        mesh = Mesh.uniform(ns)
+        n = ns + 1
+        if not with_sampler:
+            sampler = None
+        elif alpha is None:
+            sampler = Circulant_Sampler2D.from_cov(gaussA_exp, n, n, 1/ns, 1/ns, (l**(-2), l**(-2), 0))
+        else:
+            m1 = n * alpha; m2 = n * alpha
+            C_red = Reduced_Cov(n + m1, n + m2, 1/ns, 1/ns, gaussA_exp, (l**(-2), l**(-2), 0))
+            sampler = Circulant_Sampler2D(C_red, n, n, m1, m2)
+        M = None
+        if solver == 'cg':
+            # E[exp(z)] = exp(c(0)/2) with c(0) = 1
+            A_mean, _ = mesh.stiffness(np.full(mesh.ne, exp(0.5)))
+            M = Preconditioner(A_mean, precond)
+        return mesh, sampler, M
+    return _MC_SETUP_CACHE.get((ns, l, alpha, solver, precond if solver == 'cg' else None, with_sampler), build)
+
+def FEM_2D_Batch_Solve(mesh, Z, solver='direct', M=None):
+    '''
+    FEM solutions of -div(a grad u) = 1 with the log-normal coefficients a = exp(Z) of MC_FEM_2D
+    Input:
+        mesh: uniform Mesh of the unit square
+        Z: [nb, ns + 1, ns + 1] Gaussian field on the vertices
+        solver, M: see FEM_Solver2D_r1, successive samples are warm-started for solver = 'cg'
+    Output:
+        uh: [nb, nvtx] nodal values
+    '''
+    nb = Z.shape[0]
+    A = np.exp(Z).reshape(nb, -1)[:, mesh.elt2vert].mean(axis=2)
+    uh = np.zeros((nb, mesh.nvtx))
+    u_int = None
+    ns = Z.shape[1] - 1
+    for i in range(nb):
+        uh[i], u_int, _, _ = FEM_Solver2D_r1(ns, mesh.xv, mesh.yv, mesh.elt2vert, mesh.nvtx, mesh.ne, A[i], np.ones(mesh.ne),
+                                             mesh, True, solver, M, u_int)
+    return uh
+
+def MC_FEM_2D(ns, Q, l, alpha, rng=None, batch=32, solver='direct', precond='ic', tol=None, level=0.95):
     '''
     Input:
         ns: number of space intervals each edge
         Q: do Monte Carlo Q times
         l: param of Gaussian covariance
-        alpha: param of padding
+        alpha: param of padding, None for the smallest padding making the embedding non-negative definite
+        rng: Generator or seed, see Get_Rng
+        batch: number of field pairs drawn per batched fft2
+        solver: 'direct' or 'cg', see FEM_Solver2D_r1
+        precond: kind of Preconditioner for solver = 'cg', built once from the mean-coefficient
+                 operator and reused with warm starts for every sample
+        tol: stop after the first batch at which the confidence interval half-width of the mean is
+             below tol at every vertex, Q is then the maximal number of samples
+        level: confidence level of the interval
     Ouput: 
         xv, yv, mean, var
     '''
-    h, xv, yv, elt2vert, nvtx, ne = Uniform_Mesh(ns)
-    n = ns + 1
-    fhandle = lambda x1, x2: gaussA_exp(x1, x2, l**(-2), l**(-2), 0)
-    m1 = n * alpha; m2 = n * alpha
-    C_red = Reduced_Cov(n + m1, n + m2, 1/ns, 1/ns, fhandle)
-    sum_u = np.zeros(nvtx)
-    sum_sq = np.zeros(nvtx)
+    mesh, sampler, M = MC_FEM_2D_Setup(ns, l, alpha, solver, precond)
+    xv, yv, elt2vert, nvtx, ne = mesh.xv, mesh.yv, mesh.elt2vert, mesh.nvtx, mesh.ne
+    rng = Get_Rng(rng)
+    uint1 = uint2 = None
+    stats = Running_Stats(nvtx)
     Q2 = Q // 2
 
-    for i in range(Q2):
-        z1, z2 = Circulant_Embed_Approx_2d(C_red, n, n, m1, m2, seed=None)
-        v1 = np.exp(z1).ravel()
-        v2 = np.exp(z2).ravel()
-        a1 = (v1[elt2vert[:, 0]] + v1[elt2vert[:, 1]] + v1[elt2vert[:, 2]]) / 3
-        a2 = (v2[elt2vert[:, 0]] + v2[elt2vert[:, 1]] + v2[elt2vert[:, 2]]) / 3
-        uh1, uint1, A1, rhs1 = FEM_Solver2D_r1(ns, xv, yv, elt2vert, nvtx, ne, a1, np.ones(ne))
-        uh2, uint2, A2, rhs2 = FEM_Solver2D_r1(ns, xv, yv, elt2vert, nvtx, ne, a2, np.ones(ne))
-        sum_u = sum_u + uh1 + uh2
-        sum_sq = sum_sq + (uh1**2 + uh2**2)
-    #     print('ok')
-    Q = Q2 * 2 
-    mean = sum_u / Q
-    var = (sum_sq - sum_u**2/Q)/(Q-1)
-    return xv, yv, mean, var, z1
+    for i0 in range(0, Q2, batch):
+        # log-normal coefficients of the whole batch, averaged over the element vertices
+        Z1, Z2 = sampler.sample(min(batch, Q2 - i0), rng)
+        A1 = np.exp(Z1).reshape(Z1.shape[0], -1)[:, elt2vert].mean(axis=2)
+        A2 = np.exp(Z2).reshape(Z2.shape[0], -1)[:, elt2vert].mean(axis=2)
+        for a1, a2 in zip(A1, A2):
+            uh1, uint1, _, rhs1 = FEM_Solver2D_r1(ns, xv, yv, elt2vert, nvtx, ne, a1, np.ones(ne), mesh, True, solver, M, uint1)
+            uh2, uint2, _, rhs2 = FEM_Solver2D_r1(ns, xv, yv, elt2vert, nvtx, ne, a2, np.ones(ne), mesh, True, solver, M, uint2)
+            stats.update(uh1)
+            stats.update(uh2)
+        if tol is not None and np.max(stats.ci_halfwidth(level)) <= tol:
+            break
+    z1 = Z1[-1]
+    return xv, yv, stats.mean, stats.var, z1
+
+# parallel Monte Carlo
+from concurrent.futures import ProcessPoolExecutor
+
+def _Run_Chunk(job):
+    func, args, nb, seed = job
+    return func(*args, nb, np.random.default_rng(seed))
+
+def Parallel_MC(func, args, Q, seed=None, chunk=64, workers=None, tol=None, level=0.95):
+    '''
+    Split Q samples into chunks of fixed size, each with its own stream spawned from one
+    SeedSequence, and merge the partial statistics in chunk order. The result depends on seed and
+    chunk only, not on the number of workers.
+    With a tolerance, the chunks are sent in rounds of one per worker and sampling stops after the
+    first chunk (in chunk order) at which the confidence interval of the mean is narrow enough.
+    Input:
+        func: func(*args, nb, rng) -> Running_Stats of nb samples drawn from the Generator rng,
+              a module-level function so that it can be sent to the worker processes
+        args: tuple of the first arguments of func
+        Q: number of samples
+        seed: seed or SeedSequence of the whole run
+        chunk: number of samples per chunk
+        workers: number of processes, None for os.cpu_count(), 1 to run in this process
+        tol: stop once the confidence interval half-width of the mean is below tol at every grid
+             point, Q is then the maximal number of samples
+        level: confidence level of the interval
+    Output:
+        Running_Stats of the samples
+    '''
+    ss = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    sizes = [min(chunk, Q - i0) for i0 in range(0, Q, chunk)]
+    jobs = [(func, args, nb, s) for nb, s in zip(sizes, ss.spawn(len(sizes)))]
+    nproc = 1 if workers == 1 else (workers or os.cpu_count())
+    step = len(jobs) if tol is None else nproc
+    pool = None if nproc == 1 else ProcessPoolExecutor(nproc)
+    stats = None
+    try:
+        for i0 in range(0, len(jobs), step):
+            parts = (map if pool is None else pool.map)(_Run_Chunk, jobs[i0:i0 + step])
+            for part in parts:
+                stats = part if stats is None else stats.merge(part)
+                if tol is not None and np.max(stats.ci_halfwidth(level)) <= tol:
+                    return stats
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return stats
+
+def MC_FEM_1d_Chunk(ne, sigma, mu, P, nb, rng):
+    '''
+    nb samples of the 1D FEM solution of MC_FEM_1d_Batch, see Parallel_MC
+    '''
+    stats = Running_Stats(ne + 1)
+    stats.update_batch(FEM_1d_Batch_Solve(ne, sigma, mu, rng.uniform(-1, 1, (nb, P))))
+    return stats
+
+def MC_FEM_2D_Chunk(ns, l, alpha, solver, precond, nb, rng):
+    '''
+    nb samples of the 2D FEM solution of MC_FEM_2D, both fields of every circulant pair are used,
+    see Parallel_MC
+    '''
+    mesh, sampler, M = MC_FEM_2D_Setup(ns, l, alpha, solver, precond)
+    Z1, Z2 = sampler.sample((nb + 1) // 2, rng)
+    stats = Running_Stats(mesh.nvtx)
+    stats.update_batch(FEM_2D_Batch_Solve(mesh, np.concatenate([Z1, Z2])[:nb], solver, M))
+    return stats
+
+def MC_FEM_1d_Parallel(ne, sigma, mu, P, Q, seed=None, chunk=4096, workers=None, tol=None, level=0.95):
+    '''
+    MC_FEM_1d on a process pool, see Parallel_MC
+    Output:
+        mean, var
+    '''
+    stats = Parallel_MC(MC_FEM_1d_Chunk, (ne, sigma, mu, P), Q, seed, chunk, workers, tol, level)
+    return stats.mean, stats.var
+
+def MC_FEM_2D_Parallel(ns, Q, l, alpha, seed=None, chunk=32, workers=None, solver='direct', precond='ic',
+                       tol=None, level=0.95):
+    '''
+    MC_FEM_2D on a process pool, every worker keeps its own mesh, sampler and preconditioner,
+    see Parallel_MC
+    Output:
+        xv, yv, mean, var
+    '''
+    stats = Parallel_MC(MC_FEM_2D_Chunk, (ns, l, alpha, solver, precond), Q, seed, chunk, workers, tol, level)
+    mesh, _, _ = MC_FEM_2D_Setup(ns, l, alpha, solver, precond)
+    return mesh.xv, mesh.yv, stats.mean, stats.var
 
 # Stochastic Galerkin Method
 def twoD_Eigenpairs(m, ell, x, y):
@@ -943,9 +2632,10 @@ def twoD_Eigenpairs(m, ell, x, y):
             cnt += 1
     return P, nu, phi
 
-def SGFEM(ns, xv, yv, elt2vert, nvtx, ne, mu_a, nu_a, phi_a, mu_f, nu_f, phi_f, P, N):
+def SGFEM(ns, xv, yv, elt2vert, nvtx, ne, mu_a, nu_a, phi_a, mu_f, nu_f, phi_f, P, N, mesh=None):
     '''
-    Give the finite element oart of Stochastic Galerkin method
+    Give the finite element oart of Stochastic Galerkin method for
+    a = mu_a + sum_{l=1}^P sqrt(nu_a[l-1]) phi_a[:, l-1] xi_l,  f = mu_f + sum_{l=1}^N sqrt(nu_f[l-1]) phi_f[:, l-1] xi_l
     Input: 
         ns: number of space partition
         xv, yv: xy coordinates of grid points
@@ -954,59 +2644,141 @@ def SGFEM(ns, xv, yv, elt2vert, nvtx, ne, mu_a, nu_a, phi_a, mu_f, nu_f, phi_f,
         ne: number of elements
         mu_a: mean of a
         nu_a: eigenvalues of a
-        phi_a: eigenfunctions of a
+        phi_a: eigenfunctions of a on the elements
         mu_f: mean of f
         nu_f: eigenvalued of f
-        phi_f: eigenfunctions of f
+        phi_f: eigenfunctions of f on the elements
         P: truncated number of a
         N: truncated number of f
+        mesh: prebuilt Mesh of (xv, yv, elt2vert)
     Output:
-        f
-        K_mats:
-        KB_mats:
-        wB:
-    '''
-    Jks, invJks, detJks = Get_Jacobian_Info(xv, yv, ne, elt2vert)
-    b_nodes = np.where((xv == 0) | (xv == 1) | (yv == 0) | (yv == 1))[0]
-    int_nodes = np.arange(nvtx) 
-    int_nodes = np.setdiff1d(int_nodes, b_nodes)    
-    # int_nodes = np.ones(nvtx, dtype='bool'); int_nodes[b_nodes]=False;  
-    # inx = np.arange(0, nvtx); int_nodes = inx[int_nodes]
+        f_vecs: interior load vectors f_l, l = 0, ..., max(P, N)
+        KB_mats: interior-boundary blocks of the stiffness matrices K_l
+        K_mats: interior blocks of the stiffness matrices K_l
+        wB: boundary values
+    '''
+    if mesh is None:
+        mesh = Mesh(xv, yv, elt2vert)
+    b_nodes = mesh.b_nodes;    int_nodes = mesh.int_nodes
     wB = g_eval(xv[b_nodes], yv[b_nodes])
     M = max(P, N)
     f_vecs = []
     KB_mats = []
     K_mats = []
-    for ell in range(M):
+    for ell in range(M + 1):
         if ell == 0:
-            a = mu_a * np.zeros(ne)
-            f = mu_f * np.zeros(ne)
+            a = mu_a * np.ones(ne)
+            f = mu_f * np.ones(ne)
         else:
             if ell <= P:
-                a = sqrt(nu_a[ell]) * phi_a[:, ell]
+                a = sqrt(nu_a[ell - 1]) * phi_a[:, ell - 1]
             else:
                 a = np.zeros(ne)
             if ell <= N:
-                f = sqrt(nu_f[ell]) * phi_f[:, ell]
+                f = sqrt(nu_f[ell - 1]) * phi_f[:, ell - 1]
             else:
                 f = np.zeros(ne)
-        Aks, bks = Get_Integration_Info_r1(ne, invJks, detJks, a, f)
-        A_ell = sparse.csc_matrix((nvtx, nvtx))
-        b_ell = sparse.csc_matrix((nvtx, 1))
-        for row_n in range(3):
-            nrow = elt2vert[:, row_n]
-            for col_n in range(3):
-                ncol = elt2vert[:, col_n]
-                A_ell = A_ell + sparse.csc_matrix((Aks[:, row_n, col_n], (nrow, ncol)), (nvtx,nvtx))
-            b_ell = b_ell + sparse.csc_matrix((bks[:, row_n], (nrow, np.zeros_like(nrow))), (nvtx, 1))
-        f_vecs.append(b_ell[int_nodes, np.zeros_like(int_nodes)])
-        print(b_ell[int_nodes, :][:, 0])
-        KB_mats.append(A_ell[int_nodes, :][:, b_nodes])
-        K_mats.append(A_ell[int_nodes, :][:, int_nodes])
+        K_ell, KB_ell = mesh.stiffness(a)
+        f_vecs.append(mesh.load(f)[int_nodes])
+        KB_mats.append(KB_ell)
+        K_mats.append(K_ell)
     return f_vecs, KB_mats, K_mats, wB
+
+def Legendre_Chaos(M, k):
+    '''
+    Multi-indices of the polynomial chaos of total degree at most k in M variables
+    Input:
+        M: number of random variables
+        k: total degree
+    Output:
+        alpha: [Q, M] multi-indices, Q = (M + k)! / (M! k!), sorted by degree, alpha[0] = 0
+    '''
+    def build(m, d):
+        # all multi-indices of m variables with total degree exactly d
+        if m == 1:
+            return [[d]]
+        return [[i] + rest for i in range(d, -1, -1) for rest in build(m - 1, d - i)]
+    return np.array([idx for d in range(k + 1) for idx in build(M, d)], dtype='int').reshape(-1, M)
+
+def Chaos_Matrices(alpha):
+    '''
+    Galerkin matrices G_l[i, j] = E[xi_l psi_i psi_j] of the orthonormal Legendre chaos psi_i of the
+    independent xi_l ~ U(-sqrt(3), sqrt(3)), using xi L_n = b_{n+1} L_{n+1} + b_n L_{n-1} with
+    b_n = sqrt(3) n / sqrt(4 n^2 - 1)
+    Input:
+        alpha: [Q, M] multi-indices, see Legendre_Chaos
+    Output:
+        G: list of the M + 1 sparse [Q, Q] matrices, G[0] = I
+    '''
+    Q, M = alpha.shape
+    pos = {tuple(idx): i for i, idx in enumerate(alpha)}
+    G = [sparse.identity(Q, format='csr')]
+    for ell in range(M):
+        rows = [];    cols = [];    vals = []
+        for i, idx in enumerate(alpha):
+            up = list(idx);    up[ell] += 1
+            j = pos.get(tuple(up))
+            if j is not None:
+                n = up[ell]
+                b = sqrt(3) * n / sqrt(4 * n**2 - 1)
+                rows += [i, j];    cols += [j, i];    vals += [b, b]
+        G.append(sparse.csr_matrix((vals, (rows, cols)), shape=(Q, Q)))
+    return G
+
+def SGFEM_Solve(ns, xv, yv, elt2vert, nvtx, ne, mu_a, nu_a, phi_a, mu_f, nu_f, phi_f, P, N, k, mesh=None, tol=1e-10):
+    '''
+    Stochastic Galerkin FEM with Legendre chaos of total degree k in xi_1, ..., xi_max(P, N). The
+    system sum_l G_l (x) K_l is never formed: it is applied as X -> sum_l K_l X G_l^T on the
+    [n_int, Q] coefficient matrix and solved by CG preconditioned by the mean block I (x) K_0
+    Input:
+        ns, ..., N, mesh: see SGFEM
+        k: total degree of the polynomial chaos
+        tol: relative residual tolerance of CG, a RuntimeError is raised if it is not met
+    Output:
+        mean: mean of u at the vertices
+        var: variance of u at the vertices
+        U: [nvtx, Q] chaos coefficients of u
+        alpha: [Q, M] multi-indices of the chaos, see Legendre_Chaos
+        it: number of CG iterations
+    '''
+    if mesh is None:
+        mesh = Mesh(xv, yv, elt2vert)
+    f_vecs, KB_mats, K_mats, wB = SGFEM(ns, xv, yv, elt2vert, nvtx, ne, mu_a, nu_a, phi_a, mu_f, nu_f, phi_f, P, N, mesh)
+    M = max(P, N)
+    alpha = Legendre_Chaos(M, k)
+    G = Chaos_Matrices(alpha)
+    Q = alpha.shape[0]
+    n = mesh.int_nodes.size
+    # E[f psi_i]: f_0 on psi_0, f_l on the first order chaos xi_l, minus the deterministic boundary data
+    Fr = np.zeros((n, Q))
+    Fr[:, 0] = f_vecs[0]
+    if k > 0:
+        # alpha[1:M+1] are the unit multi-indices e_1, ..., e_M
+        Fr[:, 1:M + 1] = np.array(f_vecs[1:]).T
+    for KB_ell, G_ell in zip(KB_mats, G):
+        Fr -= np.outer(KB_ell.dot(wB), G_ell[:, [0]].toarray())
+    def matvec(x):
+        X = x.reshape(n, Q, order='F')
+        Y = np.zeros((n, Q))
+        for K_ell, G_ell in zip(K_mats, G):
+            Y += (G_ell @ (K_ell @ X).T).T
+        return Y.ravel(order='F')
+    A = sparse.linalg.LinearOperator((n * Q, n * Q), matvec=matvec)
+    K0 = sparse.linalg.splu(sparse.csc_matrix(K_mats[0]))
+    precond = lambda r: K0.solve(r.reshape(n, Q, order='F')).ravel(order='F')
+    b = Fr.ravel(order='F')
+    x, it = PCG(A, b, precond, tol=tol)
+    res = np.linalg.norm(b - A @ x)
+    if res > tol * np.linalg.norm(b):
+        raise RuntimeError(f'PCG did not converge after {it} iterations, relative residual '
+                           f'{res / np.linalg.norm(b):.2e}, check that mu_a keeps the coefficient positive')
+    U = np.zeros((nvtx, Q))
+    U[mesh.int_nodes] = x.reshape(n, Q, order='F')
+    U[mesh.b_nodes, 0] = wB
+    return U[:, 0], np.sum(U[:, 1:]**2, axis=1), U, alpha, it
 ##############################################################################################
 # SODEs
-def EulerMaruyama(u0, T, N, d, m, f, G):
+def EulerMaruyama(u0, T, N, d, m, f, G, output='full', stride=1, quantiles=()):
     '''
     Input:
         u0: inital u(0)
@@ -1016,42 +2788,91 @@ def EulerMaruyama(u0, T, N, d, m, f, G):
         m: dim of W(t)
         f: drift term
         G: diffusion term
-        seed: random seed
+        output: 'full', 'stride', 'final' or 'stats', see Trajectory_Recorder
+        stride: keep every stride-th step when output = 'stride'
+        quantiles: quantiles tracked when output = 'stats'
     Output:
         t: time grids
         u: solution u
     '''
     dt = T / N
-    u = np.zeros((d, N+1))
     t = np.linspace(0, T, N+1)
+    rec = Trajectory_Recorder(t, (d,), output, stride, quantiles)
     u_n = np.copy(u0)
-    u[:,0] = u_n
+    rec.record(0, u_n)
     for n in range(N):
         dW = sqrt(dt) * np.random.randn(m)
         u_n = u_n + f(u_n)*dt + np.dot(G(u_n), dW)
-        u[:, n+1] = u_n
-    return t, u
+        rec.record(n+1, u_n)
+    return rec.result()
 
-def EulerMaruyamaTheta(u0, T, N, d, m, f, G, theta):
+def EulerMaruyama_Batch(u0, T, N, d, m, f, G, M, output='full', stride=1, quantiles=(), noise='general'):
+    '''
+    Euler-Maruyama method moving M paths at once
+    Input:
+        u0: inital u(0), shape (d,) shared by all paths or (M, d)
+        T: time doamin [0, T]
+        N: number of time interval
+        d: the dimension of u
+        m: dim of W(t)
+        f: drift term, maps the (M, d) states to (M, d)
+        G: diffusion term, maps the (M, d) states to the shape given by noise
+        M: number of paths
+        output: 'full', 'stride', 'final' or 'stats', see Trajectory_Recorder
+        stride: keep every stride-th step when output = 'stride'
+        quantiles: quantiles tracked when output = 'stats'
+        noise: 'general', G(u) is (M, d, m), or (d, m) if it is the same for every path;
+               'diagonal', G(u) is (M, d) or (d,) and m == d, component i is driven by W_i only;
+               'additive', G(u) is a constant scalar or (d, m), evaluated once at u0
+    Output:
+        t: time grids
+        u: [M, d, N + 1] solution paths
+    '''
+    dt = T / N
+    t = np.linspace(0, T, N+1)
+    rec = Trajectory_Recorder(t, (M, d), output, stride, quantiles)
+    u_n = np.array(np.broadcast_to(u0, (M, d)), dtype=float)
+    rec.record(0, u_n)
+    noise = noise.lower()
+    if noise not in ('general', 'diagonal', 'additive'):
+        raise ValueError(f'unknown noise type {noise}')
+    if noise == 'diagonal' and m != d:
+        raise ValueError('diagonal noise needs m == d')
+    if noise == 'additive':
+        G0 = np.broadcast_to(np.asarray(G(u_n), dtype=float), (d, m))
+    for n in range(N):
+        dW = sqrt(dt) * np.random.randn(M, m)
+        if noise == 'additive':
+            gdW = dW @ G0.T
+        elif noise == 'diagonal':
+            gdW = np.asarray(G(u_n)) * dW
+        else:
+            gdW = np.einsum('kij,kj->ki', np.broadcast_to(np.asarray(G(u_n)), (M, d, m)), dW)
+        u_n = u_n + f(u_n)*dt + gdW
+        rec.record(n+1, u_n)
+    return rec.result()
+
+def EulerMaruyamaTheta(u0, T, N, d, m, f, G, theta, output='full', stride=1, quantiles=()):
     '''
     u0: inital u(0)
     u:d-dim
     W:m-dim
     N: number of time interval
+    output, stride, quantiles: see Trajectory_Recorder
     '''
     dt = T / N
-    u = np.zeros((d, N+1))
     t = np.linspace(0, T, N+1)
+    rec = Trajectory_Recorder(t, (d,), output, stride, quantiles)
     u_n = np.copy(u0)
-    u[:,0] = u_n
+    rec.record(0, u_n)
     for n in range(N):
         dW = sqrt(dt) * np.random.randn(m)
         u_init=u_n + dt * f(u_n) + np.dot(G(u_n), dW)
         u_n = scipy.optimize.fsolve(lambda u: -u + u_n + (1-theta)*dt*f(u_n)+theta*dt*f(u)+np.dot(G(u_n), dW), u_init)
-        u[:, n+1] = u_n
-    return t, u
+        rec.record(n+1, u_n)
+    return rec.result()
 
-def GBM_exact(u0, T, N, d, m, r, sigma, seed=None):
+def GBM_exact(u0, T, N, d, m, r, sigma, seed=None, output='full', stride=1, quantiles=()):
     '''
     exact solution for Geometric Brownian Motion
     Input:
@@ -1062,20 +2883,23 @@ def GBM_exact(u0, T, N, d, m, r, sigma, seed=None):
         m: dim of W(t)
         r, sigma: param for GBM
         seed: random seed
+        output: 'full', 'stride', 'final' or 'stats', see Trajectory_Recorder
+        stride: keep every stride-th step when output = 'stride'
+        quantiles: quantiles tracked when output = 'stats'
     Output:
         t: time grids
         u: solution u
     '''
     np.random.seed(seed)
     dt = T / N
-    u = np.zeros((d, N+1))
     t = np.linspace(0, T, N+1)
-    u[:,0] = u0
+    rec = Trajectory_Recorder(t, (d,), output, stride, quantiles)
+    rec.record(0, u0)
     W = 0
     for n in range(N):
         W = W + sqrt(dt) * np.random.randn(m)
-        u[:, n+1] = np.exp((r-sigma**2/2)*t[n]+sigma*W)*u0
-    return t, u
+        rec.record(n+1, np.exp((r-sigma**2/2)*t[n]+sigma*W)*u0)
+    return rec.result()
 
 ##############################################################################################
 # time-dependent SPDE
@@ -1097,26 +2921,28 @@ def Get_onedD_bj(dtref, J, a, r):
     eps=0.001
     return np.sqrt(2 * dtref * np.arange(1,J) ** (-(2 * r + 1 + eps)) / a)
 
-def Get_onedD_dW(bj, kappa, iFspace, M):
+def Get_onedD_dW(bj, kappa, iFspace, M, rng=None):
     '''
     Input:
         bj: coefficients
         kappa: dt = kappa * dt_{ref}
         iFspace: a flag
         M: number of independent realizations to compute
+        rng: Generator of the increments, the global np.random state if None
     Output:
         dW
     '''
+    normal = np.random.standard_normal if rng is None else Get_Rng(rng).standard_normal
     if (kappa == 1):
-        nn = np.random.randn(M, bj.size)
+        nn = normal((M, bj.size))
     else:
-        nn = np.sum(np.random.randn(kappa, M, bj.size), axis=0)
+        nn = np.sum(normal((kappa, M, bj.size)), axis=0)
     X = bj * nn
     if iFspace == 1:
         dW=X
     else:
-        dW = icspde_dst1(np.squeeze(X))
-        dW = dW.reshape(X.shape)
+        # sine transform along the frequency axis of every realization
+        dW = icspde_dst1(X.T).T
     return dW
 
 # 1D H^r_{per}([0, a])-valued Weiner Process
@@ -1136,23 +2962,32 @@ def Get_onedP_bj(dtref, J, a, r):
     bj = np.sqrt(qj * dtref / a) * J
     return bj
 
-def Get_onedP_dW(bj, kappa, iFspace, M):
+def Get_onedP_dW(bj, kappa, iFspace, M, rng=None, half=False):
     '''
     Input:
         bj: coefficients
         kappa: dt = kappa * dt_{ref}
         iFspace: a flag
         M: number of independent realizations to compute
+        rng: Generator of the increments, the global np.random state if None
+        half: return the J // 2 + 1 non-negative frequencies of the Hermitian coefficients only,
+              for use with rfft/irfft; the same draws give the same increments
     Output:
         dW
     '''
     J = bj.size
+    normal = np.random.standard_normal if rng is None else Get_Rng(rng).standard_normal
     if kappa == 1:
-        nn = np.random.randn(M, J)
+        nn = normal((M, J))
     else:
-        nn = np.sum(np.random.randn(kappa, M, J), 0)
-    nn = np.vstack([nn[0:1, :], (nn[1:J//2, :] + 1j * nn[J//2 + 1:J, :]) / sqrt(2),
-                   nn[J//2:J//2+1, :], (nn[J//2-1:0:-1, :] - 1j * nn[J-1:J // 2 :-1, :])/ sqrt(2)])
+        nn = np.sum(normal((kappa, M, J)), 0)
+    # Hermitian coefficients along the frequency axis
+    if half:
+        nn = np.hstack([nn[:, 0:1], (nn[:, 1:J//2] + 1j * nn[:, J//2 + 1:J]) / sqrt(2), nn[:, J//2:J//2+1]])
+        X = bj[:J//2 + 1] * nn
+        return X if iFspace == 1 else irfft(X, J)
+    nn = np.hstack([nn[:, 0:1], (nn[:, 1:J//2] + 1j * nn[:, J//2 + 1:J]) / sqrt(2),
+                   nn[:, J//2:J//2+1], (nn[:, J//2-1:0:-1] - 1j * nn[:, J-1:J // 2 :-1])/ sqrt(2)])
     X = bj * nn
     if iFspace == 1:
         dW = X
@@ -1179,20 +3014,35 @@ def Get_twod_bj(dtref, J, a, alpha):
     bj = sqrt_qj * sqrt(dtref) * J[0] * J[1] / sqrt(a[0] * a[1])
     return bj
 
-def Get_twod_dW(bj, kappa, M):
+def Get_twod_dW(bj, kappa, M, rng=None, half=False):
     '''
     Input:
         bj: coefficient
         kappa: dt = kappa * dt_{ref}
         M: generate M independent realization
+        rng: Generator of the increments, the global np.random state if None
+        half: return the [M, J[0], J[1] // 2 + 1] half spectrum H of one increment instead,
+              dW = irfft2(H, J) has the law of dW1
     Output:
-        return dW1, dW2
+        return dW1, dW2, or H if half
     '''
     J = bj.shape
+    normal = np.random.standard_normal if rng is None else Get_Rng(rng).standard_normal
+    if half:
+        Jh = J[1] // 2 + 1
+        if (kappa == 1):
+            nn = normal((M,J[0],Jh,2))
+        else:
+            nn = np.sum(normal((kappa,M,J[0],Jh,2)),0)
+        nn2 = np.dot(nn,np.array([1,1j]))
+        # irfft2 keeps the real part of the columns 0 and J[1]/2, the other columns stand for
+        # a conjugate pair of modes
+        nn2[:, :, 1:J[1] // 2] /= sqrt(2)
+        return bj[:, :Jh] * nn2
     if (kappa == 1):
-        nn = np.random.randn(M,J[0],J[1],2)
+        nn = normal((M,J[0],J[1],2))
     else:
-        nn = np.sum(np.random.randn(kappa,M,J[0],J[1],2),0)
+        nn = np.sum(normal((kappa,M,J[0],J[1],2)),0)
     nn2 = np.dot(nn,np.array([1,1j]))
     tmp = ifft2(bj*nn2)
     dW1 = np.real(tmp)
@@ -1203,7 +3053,7 @@ def Get_twod_dW(bj, kappa, M):
 
 ##############################################################################################
 # solve spde with Euler-Maruyama Method and FDM
-def Spde_EM_FDM_Nagumo_Exponential(u0, T, a, N, J, epsilon, sigma, ell, fhandle):
+def Spde_EM_FDM_Nagumo_Exponential(u0, T, a, N, J, epsilon, sigma, ell, fhandle, output='full', stride=1, quantiles=(), rng=None, batch=64, M=None):
     '''
     Nagumo SPDE with Exponential Covariance and homogeneous Neumann boundary condition with initial condition u0
     Input:
@@ -1216,8 +3066,15 @@ def Spde_EM_FDM_Nagumo_Exponential(u0, T, a, N, J, epsilon, sigma, ell, fhandle)
         sigma: addictive noise parameter
         ell: parameter of exponential covariance
         fhandle: nonlinear term f(u)
+        output: 'full', 'stride', 'final' or 'stats', see Trajectory_Recorder
+        stride: keep every stride-th step when output = 'stride'
+        quantiles: quantiles tracked when output = 'stats'
+        rng: Generator or seed of the noise, the global np.random state if None
+        batch: number of noise pairs drawn per batched FFT, at least M
+        M: number of independent realizations advanced together as a [J + 1, M] block, u0 of
+           shape [J + 1] or [J + 1, M]; a single realization if None
     Output:
-        t, x, ut
+        t, x, ut: ut is [J + 1, ...] or [J + 1, M, ...] if M is given
     '''
     dt = T / N
     t = np.linspace(0, T, N + 1)
@@ -1228,24 +3085,34 @@ def Spde_EM_FDM_Nagumo_Exponential(u0, T, a, N, J, epsilon, sigma, ell, fhandle)
     A[0, 1] = 2
     A[-1, -2] = 2
     EE = scipy.sparse.identity(ind.size, format='csc') + (dt * epsilon/h**2) * A
-    ut = np.zeros((J + 1, t.size))
-    ut[:, 0] = u0
-    un = u0
-    EEinv = scipy.sparse.linalg.factorized(EE)
-    flag = False
+    m = 1 if M is None else M
+    un = u0 if M is None else np.broadcast_to(np.reshape(u0, (J + 1, -1)), (J + 1, M)).copy()
+    rec = Trajectory_Recorder(t, un.shape, output, stride, quantiles)
+    rec.record(0, un)
+    # one LU factorization, every step is a single multi-RHS triangular solve
+    EEinv = scipy.sparse.linalg.splu(EE).solve
+    sampler = Circulant_Sampler(np.exp(- np.abs(x) / ell))
+    normal = np.random.standard_normal if rng is None else Get_Rng(rng).standard_normal
+    dW = np.empty((0, m, J + 1));    k = 0
     for n in range(N):
         fu = fhandle(un)
-        if flag == False:
-            dW1, dW2 = Circlulant_Exponential(x, ell)
-            flag = True
-        else:
-            dW1 = dW2
-            flag=False
-        un = EEinv(un + dt * fu + sigma * sqrt(dt) * dW1)
-        ut[:, n + 1] = un
+        if k == dW.shape[0]:
+            # each sample pair gives the noise of two time steps, about batch pairs per refill
+            # whatever M is, and no more steps than are left
+            nb = (min(2 * max(1, batch // m), N - n) + 1) // 2
+            shape = (nb * m, sampler.N_tilde)
+            dW1, dW2 = sampler.transform(normal(shape) + 1j * normal(shape))
+            dW = np.empty((2 * nb, m, J + 1))
+            dW[0::2] = dW1.reshape(nb, m, J + 1);    dW[1::2] = dW2.reshape(nb, m, J + 1)
+            k = 0
+        dWn = dW[k, 0] if M is None else dW[k].T
+        k += 1
+        un = EEinv(un + dt * fu + sigma * sqrt(dt) * dWn)
+        rec.record(n + 1, un)
+    t, ut = rec.result()
     return t, x, ut
 
-def Spde_EM_FDM_Nagumo_White(u0, T, a, N, J, epsilon, sigma, fhandle):
+def Spde_EM_FDM_Nagumo_White(u0, T, a, N, J, epsilon, sigma, fhandle, output='full', stride=1, quantiles=(), rng=None, M=None):
     '''
     Nagumo SPDE with White noise and homogeneous Dirichlet boundary condition with initial condition u0
     Input:
@@ -1257,8 +3124,14 @@ def Spde_EM_FDM_Nagumo_White(u0, T, a, N, J, epsilon, sigma, fhandle):
         epsilon: parameter of Nagumo equation
         sigma: addictive noise parameter
         fhandle: nonlinear term f(u)
+        output: 'full', 'stride', 'final' or 'stats', see Trajectory_Recorder
+        stride: keep every stride-th step when output = 'stride'
+        quantiles: quantiles tracked when output = 'stats'
+        rng: Generator or seed of the noise, the global np.random state if None
+        M: number of independent realizations advanced together as a [J + 1, M] block, u0 of
+           shape [J + 1] or [J + 1, M]; a single realization if None
     Output:
-        t, x, ut
+        t, x, ut: ut is [J + 1, ...] or [J + 1, M, ...] if M is given
     '''
     dt = T / N
     h = a / J
@@ -1268,21 +3141,26 @@ def Spde_EM_FDM_Nagumo_White(u0, T, a, N, J, epsilon, sigma, fhandle):
     A = scipy.sparse.diags([-1, 2, -1], [-1, 0, 1], shape=(J + 1, J + 1), format='csc')
     A = A[:, ind]; A = A[ind, :]
     EE = scipy.sparse.identity(ind.size, format='csc') + (dt * epsilon / h**2) * A
-    ut = np.zeros((J + 1, t.size))
-    ut[:, 0] = u0
+    u0 = u0 if M is None else np.broadcast_to(np.reshape(u0, (J + 1, -1)), (J + 1, M)).copy()
+    rec = Trajectory_Recorder(t, u0.shape, output, stride, quantiles)
+    rec.record(0, u0)
+    u_full = np.zeros(u0.shape)
     un = u0[ind]
-    EEinv = scipy.sparse.linalg.factorized(EE)
+    EEinv = scipy.sparse.linalg.splu(EE).solve
+    normal = np.random.standard_normal if rng is None else Get_Rng(rng).standard_normal
     for n in range(N):
         fu = fhandle(un)
-        Wn = sqrt(dt/h) * np.random.randn(J - 1)
+        Wn = sqrt(dt/h) * normal(un.shape)
         un = EEinv(un + dt * fu + sigma * Wn)
-        ut[ind, n + 1] = un
+        u_full[ind] = un
+        rec.record(n + 1, u_full)
+    t, ut = rec.result()
     return t, x, ut
 
 
 ##############################################################################################
 # solve spde with Euler-Maruyama Method and Galerkin
-def Spde_oned_AC_EM_Galerkin(u0, T, a, N, kappa, Jref, J, epsilon, fhandle, ghandle, r, M):
+def Spde_oned_AC_EM_Galerkin(u0, T, a, N, kappa, Jref, J, epsilon, fhandle, ghandle, r, M, output='full', stride=1, quantiles=(), rng=None):
     '''
     Input:
         u0: the initial value of u(t, x)
@@ -1295,40 +3173,48 @@ def Spde_oned_AC_EM_Galerkin(u0, T, a, N, kappa, Jref, J, epsilon, fhandle, ghan
         sigma: addictive noise parameter
         fhandle: nonlinear term f(u)
         ghandle: noise term G(u)
+        output: 'full', 'stride', 'final' or 'stats', see Trajectory_Recorder
+        stride: keep every stride-th step when output = 'stride'
+        quantiles: quantiles tracked when output = 'stats'
+        rng: Generator of the noise, two runs with equal Generators, Jref and N share the reference
+             increments whatever kappa and J are, see Get_onedP_dW
     Output:
-        t, x, ut
+        t, x, u, ut
     '''
     dtref = T / N
     dt = kappa * dtref
-    t = np.linspace(0, T, N + 1)
+    t = np.linspace(0, T, N // kappa + 1)
     x = np.linspace(0, a, J+1)
-    IJJ = np.arange(J // 2 + 1, Jref - J // 2, dtype='int' )
-    kk = (2 * pi/ a) * np.hstack([np.arange(0, Jref // 2 + 1), np.arange(- Jref // 2 + 1, 0)]) 
+    # half spectrum of the real field, the modes above J/2 are truncated
+    IJJ = np.arange(J // 2 + 1, Jref // 2 + 1, dtype='int' )
+    kk = (2 * pi/ a) * np.arange(0, Jref // 2 + 1)
     Dx=1j * kk
     MM=np.real(- epsilon * Dx ** 2)
     EE=1 / (1 + dt * MM);    EE[IJJ]=0;    #EE=EE.reshape((1,EE.size));
     # initiliase noise
     iFspace=1
-    bj=Get_onedP_bj(dtref,Jref,a,r);    bj[IJJ]=0
+    bj=Get_onedP_bj(dtref,Jref,a,r)
     # set initial conditon
-    ut=np.zeros((Jref+1,N//kappa+1))
-    ut[:,0]=u0;     u=u0[0:Jref];    uh0=np.copy(fft(u))
+    rec = Trajectory_Recorder(t, (Jref + 1,), output, stride, quantiles)
+    rec.record(0, u0);     u=u0[0:Jref];    uh0=np.copy(rfft(u))
+    u_full = np.zeros(Jref + 1)
 
-    uh=np.matlib.repmat(uh0,M,1);    u=(ifft(uh))
+    uh=np.matlib.repmat(uh0,M,1);    u=irfft(uh,Jref)
     #
     for n in range(N // kappa):
         uh[:,IJJ]=0
-        fhu=fft(fhandle(np.real(u)));                fhu[:,IJJ]=0
-        dW=Get_onedP_dW(bj,kappa,iFspace,M);        dW[:,IJJ]=0
-        gdWh=fft(ghandle(u)*np.real(ifft(dW)));     gdWh[:,IJJ]=0
+        fhu=rfft(fhandle(u));                       fhu[:,IJJ]=0
+        dW=Get_onedP_dW(bj,kappa,iFspace,M,rng,half=True);    dW[:,IJJ]=0
+        gdWh=rfft(ghandle(u)*irfft(dW,Jref));       gdWh[:,IJJ]=0
         uh_new=EE*(uh + dt * fhu + gdWh);   uh=uh_new
-        u=np.real(np.copy((ifft(uh))))
-        ut[0:Jref,n + 1]=u[-1,:]
-    ut[Jref,:]=ut[0,:]
-    u=np.vstack([u,u[:]])
+        u=irfft(uh,Jref)
+        u_full[0:Jref]=u[-1,:];     u_full[Jref]=u_full[0]
+        rec.record(n + 1, u_full)
+    t, ut = rec.result()
+    u=np.hstack([u,u[:,0:1]])
     return t, x, u, ut
 
-def Spde_twod_AC_EM_Galerkin(u0, T, a, N, kappa, J, epsilon, fhandle, ghandle, alpha, M):
+def Spde_twod_AC_EM_Galerkin(u0, T, a, N, kappa, J, epsilon, fhandle, ghandle, alpha, M, output='full', stride=1, quantiles=(), rng=None):
     """
     Input:
         u0: the initial value of u(t, x)
@@ -1343,14 +3229,19 @@ def Spde_twod_AC_EM_Galerkin(u0, T, a, N, kappa, J, epsilon, fhandle, ghandle, a
         ghandle: noise term G(u)
         alpha: parameterr of Q
         M: number of independent realizations
+        output: 'full', 'stride', 'final' or 'stats', see Trajectory_Recorder
+        stride: keep every stride-th step when output = 'stride'
+        quantiles: quantiles tracked when output = 'stats'
+        rng: Generator of the noise, see Get_twod_dW
     Output:
         t, u, ut
     """
     dtref = T / N
-    Dt = kappa * dtref;    t = np.linspace(0,T,N+1)
+    Dt = kappa * dtref;    t = np.linspace(0,T,N//kappa+1)
     #
     lambdax = (2*pi/a[0]) * np.hstack([np.arange(0, J[0]//2+1), np.arange(-J[0]//2+1, 0)])
-    lambday = (2*pi/a[1]) * np.hstack([np.arange(0, J[1]//2+1), np.arange(-J[1]//2+1, 0)])
+    # the last axis keeps the half spectrum of the real field
+    lambday = (2*pi/a[1]) * np.arange(0, J[1]//2+1)
     lambdaxx, lambdayy = np.meshgrid(lambdax,lambday,indexing='ij')
     Dx = (1j * lambdaxx);    Dy = (1j * lambdayy)
     A = -(Dx ** 2 + Dy ** 2);    MM=np.real(epsilon * A)
@@ -1359,22 +3250,26 @@ def Spde_twod_AC_EM_Galerkin(u0, T, a, N, kappa, J, epsilon, fhandle, ghandle, a
     bj=Get_twod_bj(dtref,J,a,alpha)
     # initial conditions
     u = np.matlib.tile(u0[:-1, :-1], (M, 1, 1))
-    uh = np.matlib.tile(fft2(u0[:-1, 0:-1]),(M, 1, 1))
-    ut = np.zeros((J[0] + 1, J[1] + 1, N//kappa+1))
-    ut[:, :, 0]=u0
+    uh = np.matlib.tile(rfft2(u0[:-1, 0:-1]),(M, 1, 1))
+    s = (J[0], J[1])
+    rec = Trajectory_Recorder(t, (J[0] + 1, J[1] + 1), output, stride, quantiles)
+    rec.record(0, u0)
+    u_full = np.zeros((J[0] + 1, J[1] + 1))
     for n in range(N // kappa):
-        fh = fft2(fhandle(u))
-        dW, dW2 = Get_twod_dW(bj, kappa, M)
-        gudWh = fft2(ghandle(u)*dW)
+        fh = rfft2(fhandle(u))
+        dW = irfft2(Get_twod_dW(bj, kappa, M, rng, half=True), s)
+        gudWh = rfft2(ghandle(u)*dW)
         uh_new = EE*(uh + Dt * fh + gudWh)
-        u = np.real(ifft2(uh_new))
-        ut[:-1, :-1, n + 1] = u[-1,:,:]
+        u = irfft2(uh_new, s)
+        u_full[:-1, :-1] = u[-1,:,:]
+        u_full[-1, :] = u_full[0, :];   u_full[:, -1] = u_full[:, 0]
+        rec.record(n + 1, u_full)
         uh = uh_new
     u[:,-1,:] = u[:,0,:];    u[:,:,-1] = u[:,:,0]
-    ut[:,-1,:] = ut[:,0,:];   ut[-1,:,:] = ut[0,:,:]
+    t, ut = rec.result()
     return t, u, ut
 
-def Spde_EM_FEM(u0, T, a, Nref, kappa, neref, L, epsilon, fhandle, ghandle, r, M):
+def Spde_EM_FEM(u0, T, a, Nref, kappa, neref, L, epsilon, fhandle, ghandle, r, M, output='full', stride=1, quantiles=(), rng=None):
     '''
     Input:
         u0: the initial value of u(t, x)
@@ -1389,6 +3284,11 @@ def Spde_EM_FEM(u0, T, a, Nref, kappa, neref, L, epsilon, fhandle, ghandle, r, M
         ghandle: noise term G(u)
         r: 
         M: number of independent realizations
+        output: 'full', 'stride', 'final' or 'stats', see Trajectory_Recorder
+        stride: keep every stride-th step when output = 'stride'
+        quantiles: quantiles tracked when output = 'stats'
+        rng: Generator of the noise, two runs with equal Generators, neref and Nref share the
+             reference increments whatever kappa and L are, see Get_onedD_dW
     Output:
         t, u, ut
     '''
@@ -1408,13 +3308,13 @@ def Spde_EM_FEM(u0, T, a, Nref, kappa, neref, L, epsilon, fhandle, ghandle, r, M
     bj[ne:-1] = 0
     iFspace = 0
     u = np.matlib.repmat(u0, M, 1)
-    ut = np.zeros((nvtx, Nref//kappa + 1))
-    ut[:, 0] = u[0, :]
+    rec = Trajectory_Recorder(t, (nvtx,), output, stride, quantiles)
+    rec.record(0, u[0, :])
     b = np.zeros(ne - 1)
     gdw = np.copy(b)
     EEinv = scipy.sparse.linalg.factorized(EE)
     for k in range(Nref//kappa):
-        dWJ = Get_onedD_dW(bj, kappa, iFspace, M)
+        dWJ = Get_onedD_dW(bj, kappa, iFspace, M, rng)
         dWL = np.hstack([ZM, dWJ, ZM])
         dWL = dWL[:, ::L]
         gdW = ghandle(u) * dWL
@@ -1424,5 +3324,188 @@ def Spde_EM_FEM(u0, T, a, Nref, kappa, neref, L, epsilon, fhandle, ghandle, r, M
             gdw = oned_linear_FEM_b(ne, h, gdW[m, :])
             u1 = EEinv(MM.dot(u[m, 1:-1]) + dt * b + gdw)
             u[m, :] = np.hstack([0, u1, 0])
-        ut[:, k + 1] = u[-1, :]
-    return t, u, ut
\ No newline at end of file
+        rec.record(k + 1, u[-1, :])
+    t, ut = rec.result()
+    return t, u, ut
+
+##############################################################################################
+# Multilevel Monte Carlo
+def MLMC(level_fn, eps, args=(), L0=2, Lmax=10, N0=100, rng=None, alpha=None, beta=None, gamma=None, batch=1024):
+    '''
+    Multilevel Monte Carlo estimate of E[P_L] with root mean square error eps (Giles, 2008):
+    E[P_L] = E[P_0] + sum_{l=1}^L E[P_l - P_{l-1}], each correction sampled from coupled
+    fine/coarse pairs sharing their random input
+    Input:
+        level_fn: level_fn(l, Nl, rng, *args) -> (Y, cost), Y the Nl samples of P_l - P_{l-1}
+                  (of P_0 on level 0) and cost the total cost of these samples
+        eps: target root mean square error
+        args: tuple of the extra arguments of level_fn
+        L0: the levels 0, ..., L0 are sampled first, L0 >= 2 for the regressions
+        Lmax: maximal finest level, the bias may exceed eps / sqrt(2) once it is reached
+        N0: number of warm-up samples on each new level
+        rng: Generator or seed, see Get_Rng
+        alpha, beta, gamma: rates |E[P_l - P_{l-1}]| ~ 2^{-alpha l}, V[P_l - P_{l-1}] ~ 2^{-beta l}
+                            and cost ~ 2^{gamma l}, estimated by regression on the levels l >= 1
+                            when None, levels with a zero mean or variance are left out
+        batch: largest number of samples asked from level_fn at once, bounds the memory
+    Output:
+        P: estimate of E[P_L]
+        Nl: numbers of samples on each level
+        ml, Vl, Cl: means, variances and costs per sample on each level
+    '''
+    rng = Get_Rng(rng)
+    def rate(y, lv, sign):
+        # sign * log2 slope over the levels with y > 0, 0.5 at least
+        keep = y > 0
+        if np.sum(keep) < 2:
+            return 0.5
+        return max(0.5, sign * np.polyfit(lv[keep], np.log2(y[keep]), 1)[0])
+    L = L0
+    stats = [Running_Stats(()) for l in range(L + 1)]
+    cost = np.zeros(L + 1)
+    dN = np.full(L + 1, N0)
+    while np.sum(dN) > 0:
+        for l in range(L + 1):
+            for i0 in range(0, int(dN[l]), batch):
+                Y, c = level_fn(l, min(batch, int(dN[l]) - i0), rng, *args)
+                stats[l].update_batch(np.asarray(Y, dtype=float))
+                cost[l] += c
+        Nl = np.array([st.n for st in stats])
+        ml = np.abs([st.mean for st in stats])
+        Vl = np.array([st.var for st in stats])
+        Cl = cost / Nl
+        lv = np.arange(1, L + 1)
+        a = alpha if alpha is not None else rate(ml[1:], lv, -1)
+        b = beta if beta is not None else rate(Vl[1:], lv, -1)
+        g = gamma if gamma is not None else rate(Cl[1:], lv, 1)
+        Vl = np.maximum(Vl, 1e-300)
+        # keep the estimates of the deep levels, based on few samples, consistent with the decay
+        for l in range(2, L + 1):
+            ml[l] = max(ml[l], 0.5 * ml[l - 1] / 2**a)
+            Vl[l] = max(Vl[l], 0.5 * Vl[l - 1] / 2**b)
+        # optimal numbers of samples for the variance eps^2 / 2
+        Ns = np.ceil(2 * np.sqrt(Vl / Cl) * np.sum(np.sqrt(Vl * Cl)) / eps**2)
+        dN = np.maximum(0, Ns - Nl)
+        if np.all(dN <= 0.01 * Nl):
+            # bias eps^2 / 2, estimated from the last two levels
+            rem = max(ml[L], ml[L - 1] / 2**a) / (2**a - 1)
+            if rem > eps / sqrt(2) and L < Lmax:
+                L += 1
+                stats.append(Running_Stats(()))
+                cost = np.append(cost, 0.0)
+                Vl = np.append(Vl, Vl[-1] / 2**b)
+                Cl = np.append(Cl, Cl[-1] * 2**g)
+                Nl = np.append(Nl, 0)
+                Ns = np.ceil(2 * np.sqrt(Vl / Cl) * np.sum(np.sqrt(Vl * Cl)) / eps**2)
+                dN = np.maximum(0, Ns - Nl)
+                dN[L] = max(dN[L], N0)
+    P = sum(st.mean for st in stats)
+    ml = np.array([st.mean for st in stats])
+    Vl = np.array([st.var for st in stats])
+    return P, Nl, ml, Vl, cost / Nl
+
+def MLMC_FEM_1d_Level(l, Nl, rng, ne0=8, sigma=4, mu=1, P=10, qoi=None):
+    '''
+    Level l of MC_FEM_1d for MLMC: ne0 * 2^l elements, the coarse mesh with half as many elements
+    sees the same random variables of the KL expansion of a(x)
+    Input:
+        l, Nl, rng: see MLMC
+        ne0: number of elements on level 0
+        sigma, mu, P: see MC_FEM_1d
+        qoi: qoi(uh) -> [Nl] quantity of interest of the [Nl, ne + 1] nodal values, u(1/2) if None
+    Output:
+        Y, cost
+    '''
+    qoi = qoi or (lambda uh: uh[:, (uh.shape[1] - 1) // 2])
+    xi = rng.uniform(-1, 1, (Nl, P))
+    ne = ne0 * 2**l
+    Y = qoi(FEM_1d_Batch_Solve(ne, sigma, mu, xi))
+    cost = Nl * ne
+    if l > 0:
+        Y = Y - qoi(FEM_1d_Batch_Solve(ne // 2, sigma, mu, xi))
+        cost += Nl * ne // 2
+    return Y, cost
+
+def MLMC_FEM_2D_Level(l, Nl, rng, ns0=4, ell=0.3, solver='direct', precond='ic', qoi=None):
+    '''
+    Level l of MC_FEM_2D for MLMC: ns0 * 2^l intervals each edge, the Gaussian field of the coarse
+    mesh is the restriction of the fine one to the coarse vertices
+    Input:
+        l, Nl, rng: see MLMC
+        ns0: number of intervals each edge on level 0
+        ell: param of Gaussian covariance
+        solver, precond: see MC_FEM_2D
+        qoi: qoi(uh) -> [Nl] quantity of interest of the [Nl, nvtx] nodal values, u(1/2, 1/2) if None
+    Output:
+        Y, cost
+    '''
+    qoi = qoi or (lambda uh: uh[:, uh.shape[1] // 2])
+    ns = ns0 * 2**l
+    mesh, sampler, M = MC_FEM_2D_Setup(ns, ell, None, solver, precond)
+    Z1, Z2 = sampler.sample((Nl + 1) // 2, rng)
+    Z = np.concatenate([Z1, Z2])[:Nl]
+    Y = qoi(FEM_2D_Batch_Solve(mesh, Z, solver, M))
+    cost = Nl * ns**2
+    if l > 0:
+        mesh_c, _, M_c = MC_FEM_2D_Setup(ns // 2, ell, None, solver, precond, with_sampler=False)
+        Y = Y - qoi(FEM_2D_Batch_Solve(mesh_c, Z[:, ::2, ::2], solver, M_c))
+        cost += Nl * ns**2 // 4
+    return Y, cost
+
+def MLMC_Spde_Galerkin_Level(l, Nl, rng, u0, T, a, N0, J0, epsilon, fhandle, ghandle, r, qoi=None):
+    '''
+    Level l of Spde_oned_AC_EM_Galerkin for MLMC: N0 * 2^l time steps and J0 * 2^l modes, the coarse
+    run takes kappa = 2 and half of the modes on the same reference increments
+    Input:
+        l, Nl, rng: see MLMC
+        u0: function of x giving the initial value
+        T, a, epsilon, fhandle, ghandle, r: see Spde_oned_AC_EM_Galerkin
+        N0, J0: number of time steps and of space intervals on level 0
+        qoi: qoi(u) -> [Nl] quantity of interest of u(T, x_j), [Nl, J + 1], u(T, a/2) if None
+    Output:
+        Y, cost
+    '''
+    qoi = qoi or (lambda u: u[:, (u.shape[1] - 1) // 2])
+    N = N0 * 2**l
+    J = J0 * 2**l
+    u0x = u0(np.linspace(0, a, J + 1))
+    seed = rng.integers(2**63)
+    def run(kappa, Jc):
+        _, _, u, _ = Spde_oned_AC_EM_Galerkin(u0x, T, a, N, kappa, J, Jc, epsilon, fhandle, ghandle, r, Nl, 'final',
+                                              rng=np.random.default_rng(seed))
+        return qoi(u)
+    Y = run(1, J)
+    cost = Nl * N * J
+    if l > 0:
+        Y = Y - run(2, J // 2)
+        cost += Nl * N * J // 2
+    return Y, cost
+
+def MLMC_Spde_FEM_Level(l, Nl, rng, u0, T, a, N0, ne0, epsilon, fhandle, ghandle, r, qoi=None):
+    '''
+    Level l of Spde_EM_FEM for MLMC: N0 * 2^l time steps and ne0 * 2^l elements, the coarse run takes
+    kappa = 2 and L = 2 on the same reference increments
+    Input:
+        l, Nl, rng: see MLMC
+        u0: function of x giving the initial value
+        T, a, epsilon, fhandle, ghandle, r: see Spde_EM_FEM
+        N0, ne0: number of time steps and of elements on level 0
+        qoi: qoi(u) -> [Nl] quantity of interest of u(T, x_j), [Nl, ne + 1], u(T, a/2) if None
+    Output:
+        Y, cost
+    '''
+    qoi = qoi or (lambda u: u[:, (u.shape[1] - 1) // 2])
+    N = N0 * 2**l
+    ne = ne0 * 2**l
+    seed = rng.integers(2**63)
+    def run(kappa, L):
+        u0x = u0(np.linspace(0, a, ne // L + 1))
+        _, u, _ = Spde_EM_FEM(u0x, T, a, N, kappa, ne, L, epsilon, fhandle, ghandle, r, Nl, 'final',
+                              rng=np.random.default_rng(seed))
+        return qoi(u)
+    Y = run(1, 1)
+    cost = Nl * N * ne
+    if l > 0:
+        Y = Y - run(2, 2)
+        cost += Nl * N * ne // 4
+    return Y, cost